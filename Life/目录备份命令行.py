@@ -0,0 +1,229 @@
+# 目录备份命令行：不打开界面，按界面保存的 backup_config.json 执行一次备份，适合计划任务、cron等无人值守的定时备份
+# 不导入tkinter，启动快；日志每行一个JSON，警告不弹窗，收集起来在结束时汇总，并通过退出码反映结果
+# --watch 为监视模式：先完整备份一次，之后订阅文件变化，变化平息后只备份变化的路径，直到Ctrl+C
+# --verify 不备份，只校验已有的备份与源文件是否一致，不一致时退出码为1
+# --restore 按去重块存储中的某个索引文件把备份还原到 --to 指定的目录
+import argparse
+import json
+import signal
+import sys
+import threading
+import time
+
+from 目录备份引擎 import (BackupEngine, LogEvent, WarningEvent, FinishedEvent, MetricsEvent, create_watcher,
+                    format_log_record,
+                    restore_from_chunk_store, DEFAULT_COPY_WORKERS, DEFAULT_COMPRESS_WORKERS, DEFAULT_POLL_INTERVAL,
+                    DEFAULT_VERIFY_WORKERS, DEFAULT_ITEM_WORKERS, DEFAULT_DEVICE_CONCURRENCY)
+
+EXIT_OK = 0  # 备份完成，没有警告
+EXIT_WARNINGS = 1  # 备份完成，但有备份项出错或不存在，详见汇总
+EXIT_CONFIG_ERROR = 2  # 配置文件不存在、格式错误或没有设置备份根目录
+EXIT_CANCELED = 130  # 被Ctrl+C或SIGTERM中断，已完成的部分下次会继续
+DEFAULT_DEBOUNCE = 2  # 监视模式下最后一次变化后等待多少秒再备份，避免文件还在写入时就开始拷贝
+DEFAULT_MAX_DELAY = 60  # 变化持续不断时，最多攒多少秒就备份一次
+DEFAULT_FULL_INTERVAL = 6 * 3600  # 监视模式下每隔多少秒做一次完整备份，补上通知遗漏的变化
+
+
+class CommandLineEvents:
+    # 代替界面的事件队列：引擎发来的事件直接写成结构化日志，警告收集起来最后汇总，不阻塞备份
+
+    def __init__(self, log_file):
+        self.log_file = log_file
+        self.warnings = []
+        self.canceled = False
+        self.lock = threading.Lock()  # 引擎可能在多个线程中发事件
+
+    def put(self, event):
+        with self.lock:
+            if isinstance(event, LogEvent):
+                self.write('info', event.message)
+            elif isinstance(event, WarningEvent):
+                self.warnings.append(event)
+                self.write('warning', event.message, title=event.title)
+            elif isinstance(event, MetricsEvent):
+                self.write('metrics', f"性能统计：{event.path}", summary=event.summary)
+            elif isinstance(event, FinishedEvent):
+                self.canceled = event.canceled
+            # 进度事件在命令行下不需要，忽略
+
+    def write(self, level, message, **fields):
+        self.log_file.write(format_log_record(level, message, **fields))
+        self.log_file.flush()
+
+
+def load_config(config_path):
+    # 读取界面保存的配置，返回 (配置, 错误信息)
+    try:
+        with open(config_path, 'r') as file:
+            config = json.load(file)
+    except FileNotFoundError:
+        return None, f"配置文件 {config_path} 不存在，请先在界面中设置备份根目录和备份目标。"
+    except (OSError, ValueError) as e:
+        return None, f"读取配置文件 {config_path} 出错: {e}"
+    if not config.get('backup_root'):
+        return None, f"配置文件 {config_path} 中没有设置备份根目录。"
+    return config, None
+
+
+class BackupRunner:
+    # 在后台线程中运行备份引擎，主线程只等待，这样信号处理函数能及时执行
+
+    def __init__(self, config, args, events):
+        self.config = config
+        self.args = args
+        self.events = events
+        self.engine = None
+        self.stop_event = threading.Event()
+
+    def stop(self, signum=None, frame=None):
+        # 收到中断信号时请求引擎在下一个数据块处停止，而不是直接杀掉进程留下不完整的文件
+        self.stop_event.set()
+        if self.engine is not None:
+            self.engine.cancel()
+
+    def run_backup(self, dirty_paths=None, verify=False):
+        if self.stop_event.is_set():
+            return
+        self.engine = BackupEngine(
+            self.config['backup_root'], self.config.get('backup_items', []),
+            max(1, self.args.copy_workers or self.config.get('copy_workers', DEFAULT_COPY_WORKERS)),
+            self.events,
+            max(1, self.args.compress_workers or self.config.get('compress_workers', DEFAULT_COMPRESS_WORKERS)),
+            dirty_paths, max(1, self.args.verify_workers),
+            max(1, self.args.item_workers or self.config.get('item_workers', DEFAULT_ITEM_WORKERS)),
+            max(1, self.args.device_concurrency or self.config.get('device_concurrency', DEFAULT_DEVICE_CONCURRENCY)),
+            self.args.metrics or self.config.get('collect_metrics', False),
+            self.args.remote or self.config.get('remote_destination', False),
+            int(self.setting('recycle_max_size', 'recycle_max_size_gb') * 1024 ** 3),
+            self.setting('recycle_max_age', 'recycle_max_age_days') * 86400)
+        backup_thread = threading.Thread(target=self.engine.run, args=(verify,))
+        backup_thread.start()
+        while backup_thread.is_alive():
+            backup_thread.join(0.5)
+        self.engine = None
+
+    def setting(self, arg_name, config_key):
+        # 命令行参数优先，没有指定时使用配置文件中的设置，都没有时为0（不限）
+        value = getattr(self.args, arg_name)
+        return max(0.0, value if value is not None else self.config.get(config_key, 0))
+
+    def watch(self):
+        # 变化的路径按备份目标攒在pending中（值为None表示需要完整扫描），最后一次变化后平息debounce秒，
+        # 或者最早的变化已经等了max_delay秒时，只备份这些路径
+        items = self.config.get('backup_items', [])
+        watcher, method = create_watcher(items, self.args.poll_interval)
+        try:
+            self.events.write('info', f"开始监视 {len(items)} 个备份目标，方式：{method}")
+            self.run_backup()
+            last_full = time.monotonic()
+            pending = {}
+            first_change = last_change = None
+            while not self.stop_event.is_set():
+                changes = watcher.wait(0.5)
+                now = time.monotonic()
+                for path, dirty in changes.items():
+                    if dirty is None or pending.get(path, set()) is None:
+                        pending[path] = None
+                    else:
+                        pending.setdefault(path, set()).update(dirty)
+                if changes:
+                    last_change = now
+                    first_change = first_change or now
+                if pending and (now - last_change >= self.args.debounce or now - first_change >= self.args.max_delay):
+                    batch, pending = pending, {}
+                    first_change = None
+                    self.events.write('info', f"检测到变化，备份 {len(batch)} 个备份目标",
+                                      paths={path: None if dirty is None else len(dirty) for path, dirty in batch.items()})
+                    self.run_backup(batch)
+                elif not pending and now - last_full >= self.args.full_interval:
+                    self.run_backup()
+                    last_full = now
+        finally:
+            watcher.close()
+        return False  # 监视模式只能通过Ctrl+C结束，这是正常的退出方式
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="按 backup_config.json 执行一次备份，不打开界面。")
+    parser.add_argument('--config', default='backup_config.json', help="配置文件路径，默认是当前目录下的 backup_config.json")
+    parser.add_argument('--log-file', help="把日志追加到此文件，默认输出到标准输出")
+    parser.add_argument('--copy-workers', type=int, help="并行拷贝数，默认使用配置文件中的设置")
+    parser.add_argument('--compress-workers', type=int, help="并行压缩数，默认使用配置文件中的设置")
+    parser.add_argument('--item-workers', type=int, help="同时进行的备份目标数，默认使用配置文件中的设置")
+    parser.add_argument('--device-concurrency', type=int,
+                        help="每块磁盘上同时进行的备份目标数，默认使用配置文件中的设置")
+    parser.add_argument('--metrics', action='store_true',
+                        help="记录各阶段的性能统计，保存到清单目录下并写入日志，默认使用配置文件中的设置")
+    parser.add_argument('--remote', action='store_true',
+                        help="网络目标模式：备份根目录在NAS/SMB等高延迟的位置时，批量列出目标目录，减少逐个文件的往返，"
+                             "默认使用配置文件中的设置")
+    parser.add_argument('--recycle-max-size', type=float, metavar='GB',
+                        help="所有回收站的总大小上限，超出时从最旧的回收站开始删除，0为不限，默认使用配置文件中的设置")
+    parser.add_argument('--recycle-max-age', type=float, metavar='DAYS',
+                        help="回收站保留的天数，更早的回收站被删除，0为不限，默认使用配置文件中的设置")
+    parser.add_argument('--watch', action='store_true', help="监视模式：持续监视备份目标，有变化时只备份变化的文件")
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE, help="监视模式下变化平息多少秒后开始备份")
+    parser.add_argument('--max-delay', type=float, default=DEFAULT_MAX_DELAY, help="监视模式下变化持续时最多等待多少秒")
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+                        help="没有文件系统通知可用时轮询扫描的间隔秒数")
+    parser.add_argument('--full-interval', type=float, default=DEFAULT_FULL_INTERVAL,
+                        help="监视模式下完整备份的间隔秒数")
+    parser.add_argument('--verify', action='store_true', help="不备份，校验已有的备份与源文件是否一致")
+    parser.add_argument('--verify-workers', type=int, default=DEFAULT_VERIFY_WORKERS, help="校验时并行计算摘要的进程数")
+    parser.add_argument('--restore', metavar='INDEX', help="按去重块存储中的索引文件还原，需同时指定 --to")
+    parser.add_argument('--to', metavar='DIR', help="还原到的目录")
+    args = parser.parse_args(argv)
+
+    if args.restore:
+        if not args.to:
+            parser.error("--restore 需要同时指定 --to")
+        try:
+            count = restore_from_chunk_store(args.restore, args.to)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"还原失败: {e}", file=sys.stderr)
+            return EXIT_WARNINGS
+        print(f"已还原 {count} 个文件到 {args.to}", file=sys.stderr)
+        return EXIT_OK
+
+    config, error = load_config(args.config)
+    if error:
+        print(error, file=sys.stderr)
+        return EXIT_CONFIG_ERROR
+
+    log_file = open(args.log_file, 'a', encoding='utf-8') if args.log_file else sys.stdout
+    try:
+        events = CommandLineEvents(log_file)
+        runner = BackupRunner(config, args, events)
+        signal.signal(signal.SIGINT, runner.stop)
+        if hasattr(signal, 'SIGTERM'):
+            signal.signal(signal.SIGTERM, runner.stop)
+
+        start_time = time.time()
+        if args.watch:
+            events.canceled = runner.watch()
+        elif args.verify:
+            runner.run_backup(verify=True)
+        else:
+            runner.run_backup()
+
+        if events.canceled:
+            exit_code = EXIT_CANCELED
+        elif events.warnings:
+            exit_code = EXIT_WARNINGS
+        else:
+            exit_code = EXIT_OK
+        events.write('summary', f"{'校验' if args.verify else '备份'}{'已取消' if events.canceled else '结束'}，共 {len(events.warnings)} 个警告",
+                     exit_code=exit_code, elapsed=round(time.time() - start_time, 3),
+                     warnings=[{'title': w.title, 'message': w.message} for w in events.warnings])
+    finally:
+        if log_file is not sys.stdout:
+            log_file.close()
+
+    # 汇总同时输出到标准错误，方便计划任务的邮件或日志查看
+    for warning in events.warnings:
+        print(f"[{warning.title}] {warning.message}", file=sys.stderr)
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,293 @@
+# 目录备份基准测试：按固定的随机种子生成可重复的合成源目录，不打开界面运行备份引擎，
+# 分别计时首次完整备份、无变化的重新扫描、1%文件变化的增量备份和压缩备份，结果输出为JSON，
+# 便于比较不同提交之间的性能变化。例如：
+#   python 目录备份基准测试.py --scale 0.2 --output 基准结果.json
+# 注意：源文件刚刚生成，都在页面缓存中，测得的是热缓存下的速度
+# --latency 在备份目录的每次文件操作上加入固定延迟，模拟NAS/SMB等网络目标，比较普通模式和网络目标模式
+import argparse
+import builtins
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from 目录备份引擎 import (BackupEngine, LogEvent, WarningEvent, FinishedEvent,
+                    DEFAULT_COPY_WORKERS, DEFAULT_COMPRESS_WORKERS)
+
+BENCHMARK_VERSION = 1  # 合成目录或场景有变化时加一，不同版本的结果不能直接比较
+DEFAULT_SEED = 20240101
+TINY_FILE_COUNT = 20000  # scale为1时的小文件数
+TINY_FILE_MAX_SIZE = 4096
+HUGE_FILE_COUNT = 2
+HUGE_FILE_SIZE = 256 * 1024 * 1024
+DEEP_NESTING_LEVELS = 40  # 深层嵌套目录的层数，每层放几个文件
+MIXED_FILE_COUNT = 200  # 可压缩性不同的中等文件数
+MIXED_FILE_MAX_SIZE = 2 * 1024 * 1024
+CHANGED_FRACTION = 0.01  # 增量备份场景中修改的文件比例
+WORDS = [b'backup', b'manifest', b'directory', b'archive', b'snapshot', b'\xe5\xa4\x87\xe4\xbb\xbd', b'data',
+         b'the', b'of', b'and', b'file', b'copy', b'zip', b'time', b'size', b'\n']
+
+
+class BenchmarkEvents:
+    # 代替界面的事件队列：只统计日志数和警告，基准测试不关心具体内容
+
+    def __init__(self):
+        self.logs = 0
+        self.warnings = []
+        self.canceled = False
+
+    def put(self, event):
+        if isinstance(event, LogEvent):
+            self.logs += 1
+        elif isinstance(event, WarningEvent):
+            self.warnings.append(event.message)
+        elif isinstance(event, FinishedEvent):
+            self.canceled = event.canceled
+
+
+def compressible_bytes(rng, size):
+    # 类似文本的数据，压缩率高
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        parts.append(word)
+        parts.append(b' ')
+        length += len(word) + 1
+    return b''.join(parts)[:size]
+
+
+def file_content(rng, kind, size):
+    if kind == 'random':
+        return rng.randbytes(size)  # 不可压缩
+    if kind == 'zeros':
+        return bytes(size)
+    if kind == 'text':
+        return compressible_bytes(rng, size)
+    # 一半文本一半随机，介于两者之间
+    half = size // 2
+    return compressible_bytes(rng, half) + rng.randbytes(size - half)
+
+
+def generate_tree(root, scale, seed):
+    # 生成合成源目录，返回 {'files': 文件数, 'bytes': 总字节数}；同样的scale和seed生成的内容完全相同
+    rng = random.Random(seed)
+    files = 0
+    total = 0
+
+    def write(path, data):
+        nonlocal files, total
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as file:
+            file.write(data)
+        files += 1
+        total += len(data)
+
+    # 大量小文件，分散在两级目录中
+    for index in range(max(1, int(TINY_FILE_COUNT * scale))):
+        write(os.path.join(root, 'tiny', f'd{index % 50:02d}', f'e{index % 7}', f'f{index:06d}.txt'),
+              file_content(rng, rng.choice(('text', 'random')), rng.randint(0, TINY_FILE_MAX_SIZE)))
+    # 少量大文件：一个不可压缩，一个混合
+    for index in range(HUGE_FILE_COUNT):
+        path = os.path.join(root, 'huge', f'image{index}.bin')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = max(1, int(HUGE_FILE_SIZE * scale))
+        with open(path, 'wb') as file:
+            written = 0
+            while written < size:
+                block = min(size - written, 8 * 1024 * 1024)
+                file.write(file_content(rng, 'random' if index == 0 else 'mixed', block))
+                written += block
+        files += 1
+        total += size
+    # 深层嵌套
+    path = os.path.join(root, 'deep')
+    for level in range(DEEP_NESTING_LEVELS):
+        path = os.path.join(path, f'level{level:02d}')
+        for index in range(3):
+            write(os.path.join(path, f'f{index}.dat'), file_content(rng, 'text', rng.randint(100, 20000)))
+    # 可压缩性不同的中等文件
+    for index in range(max(1, int(MIXED_FILE_COUNT * scale))):
+        kind = ('text', 'random', 'zeros', 'mixed')[index % 4]
+        write(os.path.join(root, 'mixed', f'{kind}{index:04d}.dat'),
+              file_content(rng, kind, rng.randint(1, max(1, int(MIXED_FILE_MAX_SIZE * scale)))))
+    return {'files': files, 'bytes': total}
+
+
+def modify_tree(root, fraction, seed):
+    # 按固定的种子选出一部分文件改写末尾，返回修改的文件数和字节数
+    rng = random.Random(seed + 1)
+    paths = sorted(os.path.join(dir_path, name) for dir_path, _, names in os.walk(root) for name in names)
+    chosen = rng.sample(paths, max(1, int(len(paths) * fraction)))
+    total = 0
+    for path in chosen:
+        with open(path, 'ab') as file:
+            file.write(b'changed\n')
+        # 修改时间不一定有变化（精度不足时），显式往后调整
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 2_000_000_000))
+        total += st.st_size
+    return len(chosen), total
+
+
+class LatencyInjector:
+    # 在with块中，对prefix下路径的每次文件系统操作先等待seconds秒，模拟每次操作都要网络往返的目标
+    # 替换的是os模块和open的属性，引擎和shutil都通过它们访问文件，所以都会受影响
+    OS_FUNCTIONS = ('stat', 'lstat', 'scandir', 'listdir', 'mkdir', 'rename', 'replace', 'remove', 'unlink',
+                    'rmdir', 'utime', 'chmod')
+
+    def __init__(self, prefix, seconds):
+        self.prefix = os.path.abspath(prefix)
+        self.seconds = seconds
+        self.originals = {}
+
+    def wrap(self, function):
+        def delayed(*args, **kwargs):
+            if any(isinstance(arg, str) and arg.startswith(self.prefix) for arg in args[:2]):
+                time.sleep(self.seconds)
+            return function(*args, **kwargs)
+        return delayed
+
+    def __enter__(self):
+        for name in self.OS_FUNCTIONS:
+            self.originals[(os, name)] = getattr(os, name)
+            setattr(os, name, self.wrap(getattr(os, name)))
+        for module in (builtins, io):
+            self.originals[(module, 'open')] = module.open
+            module.open = self.wrap(module.open)
+        return self
+
+    def __exit__(self, *exc_info):
+        for (module, name), function in self.originals.items():
+            setattr(module, name, function)
+        self.originals = {}
+
+
+def run_engine(backup_root, items, args, remote_destination=False):
+    # 运行一次备份，返回计时结果
+    events = BenchmarkEvents()
+    engine = BackupEngine(backup_root, items, args.copy_workers, events, args.compress_workers,
+                          remote_destination=remote_destination)
+    start = time.perf_counter()
+    engine.run()
+    seconds = time.perf_counter() - start
+    return {
+        'seconds': round(seconds, 4),
+        'bytes': engine.progress.done,
+        'mb_per_s': round(engine.progress.done / 1024 ** 2 / seconds, 2) if seconds else None,
+        'warnings': events.warnings,
+        'canceled': events.canceled,
+    }
+
+
+def git_commit():
+    # 当前提交，便于把结果和代码版本对应；不在git仓库中时返回None
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="生成合成源目录并计时备份引擎的各个场景，结果输出为JSON。")
+    parser.add_argument('--dir', help="生成源目录和备份的工作目录，默认使用临时目录，结束后删除")
+    parser.add_argument('--scale', type=float, default=1.0, help="数据量的比例，1.0约为750MB")
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help="随机种子，相同种子生成相同的源目录")
+    parser.add_argument('--output', help="把结果写到这个JSON文件，默认输出到标准输出")
+    parser.add_argument('--copy-workers', type=int, default=DEFAULT_COPY_WORKERS, help="并行拷贝数")
+    parser.add_argument('--compress-workers', type=int, default=DEFAULT_COMPRESS_WORKERS, help="并行压缩数")
+    parser.add_argument('--latency', type=float, default=0,
+                        help="另外在备份目录的每次文件操作上加入这么多毫秒的延迟，比较普通模式和网络目标模式")
+    parser.add_argument('--keep', action='store_true', help="保留工作目录，便于检查")
+    args = parser.parse_args(argv)
+
+    work_dir = os.path.abspath(args.dir) if args.dir else tempfile.mkdtemp(prefix='备份基准测试_')
+    source = os.path.join(work_dir, 'source')
+    if os.path.exists(source):
+        shutil.rmtree(source)
+    try:
+        print(f"生成源目录 {source} ...", file=sys.stderr)
+        start = time.perf_counter()
+        tree = generate_tree(source, args.scale, args.seed)
+        tree['generate_seconds'] = round(time.perf_counter() - start, 4)
+
+        results = {}
+        plain_root = os.path.join(work_dir, 'backup_plain')
+        zip_root = os.path.join(work_dir, 'backup_zip')
+        for root in (plain_root, zip_root):
+            shutil.rmtree(root, ignore_errors=True)
+            os.makedirs(root)
+        plain_items = [{'path': source, 'zip': False, 'is_dir': True}]
+        zip_items = [{'path': source, 'zip': True, 'is_dir': True}]
+
+        # 各场景依次运行，后面的场景依赖前面留下的备份
+        scenarios = [
+            ('full_backup', plain_root, plain_items),
+            ('noop_rescan', plain_root, plain_items),
+            ('incremental_1_percent', plain_root, plain_items),
+            ('zip_full', zip_root, zip_items),
+            ('zip_noop_rescan', zip_root, zip_items),
+        ]
+        for name, root, items in scenarios:
+            if name == 'incremental_1_percent':
+                changed_files, changed_bytes = modify_tree(source, CHANGED_FRACTION, args.seed)
+            print(f"运行 {name} ...", file=sys.stderr)
+            results[name] = run_engine(root, items, args)
+            if name == 'incremental_1_percent':
+                results[name]['changed_files'] = changed_files
+                results[name]['changed_bytes'] = changed_bytes
+            print(f"  {results[name]['seconds']} 秒", file=sys.stderr)
+
+        # 模拟网络目标：普通模式和网络目标模式各自从空目录完整备份一次，再重新扫描一次
+        if args.latency > 0:
+            for remote in (False, True):
+                root = os.path.join(work_dir, 'backup_remote' if remote else 'backup_latency')
+                shutil.rmtree(root, ignore_errors=True)
+                os.makedirs(root)
+                for phase in ('full', 'rescan'):
+                    name = f"latency_{'remote' if remote else 'normal'}_{phase}"
+                    print(f"运行 {name} ...", file=sys.stderr)
+                    with LatencyInjector(root, args.latency / 1000):
+                        results[name] = run_engine(root, plain_items, args, remote)
+                    print(f"  {results[name]['seconds']} 秒", file=sys.stderr)
+
+        report = {
+            'benchmark_version': BENCHMARK_VERSION,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'seed': args.seed,
+            'scale': args.scale,
+            'copy_workers': args.copy_workers,
+            'compress_workers': args.compress_workers,
+            'latency_ms': args.latency,
+            'tree': tree,
+            'results': results,
+        }
+    finally:
+        if not args.keep:
+            shutil.rmtree(work_dir if not args.dir else source, ignore_errors=True)
+            if args.dir:
+                for name in ('backup_plain', 'backup_zip', 'backup_latency', 'backup_remote'):
+                    shutil.rmtree(os.path.join(work_dir, name), ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2910 @@
+# 目录备份引擎：扫描、拷贝、压缩、快照等备份逻辑，不依赖tkinter，供界面（目录备份管理器.py）和命令行（目录备份命令行.py）共用
+import json
+import math
+import os
+import contextlib
+import copy
+import ctypes
+import errno
+import fnmatch
+import functools
+import hashlib
+import heapq
+import re
+import select
+import shutil
+import stat
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime
+
+try:
+    import fcntl  # 只在类Unix系统上可用，用于reflink克隆
+except ImportError:
+    fcntl = None
+
+# 备份工具，默认不会因为原目录删除了文件而删除备份；需要备份与源保持一致时，为备份目标启用镜像模式
+
+MANIFEST_DIR_NAME = "~备份工具清单"  # 存放各备份目标文件清单的目录，位于备份根目录下
+RECYCLE_BIN_PREFIX = "~备份工具回收站_"  # 每次备份的回收站为 备份根目录/此前缀+时间戳
+RECYCLE_INDEX_FILE_NAME = "回收站索引.json"  # 各回收站的时间和大小，位于清单目录下，清理旧回收站时不必重新统计
+TEMP_FILE_SUFFIX = ".~备份临时文件"  # 拷贝时先写入 目标文件名+此后缀，完成后再改名，目标文件名下不会出现不完整的文件
+CHUNK_STORE_DIR_NAME = "~备份工具块存储"  # 去重块存储，位于备份根目录下，所有去重目标共用
+CHUNK_INDEX_DIR_SUFFIX = "_索引"  # 去重目标每次备份的文件索引存放在 块存储/目标名_索引/时间戳.json
+SNAPSHOT_DIR_SUFFIX = "_快照"  # 快照模式下，备份目标的各次快照存放在 目标名_快照/时间戳/ 下
+DEFAULT_COPY_WORKERS = 8  # 默认的并行拷贝线程数，小文件多或目标是SSD/NAS时并行能更好地利用带宽
+DEFAULT_COMPRESS_WORKERS = os.cpu_count() or 1  # 默认的并行压缩线程数，压缩是CPU密集的，按核数设置
+DEFAULT_VERIFY_WORKERS = os.cpu_count() or 1  # 默认的校验进程数，摘要计算分布到多个进程，不受GIL和单核速度限制
+DEFAULT_ITEM_WORKERS = 4  # 默认最多同时进行的备份项数
+REMOTE_LIST_WORKERS = 16  # 网络目标模式下同时列出的目录数，每次列目录是一次网络往返
+DEFAULT_DEVICE_CONCURRENCY = 2  # 默认每块磁盘（源或目标所在的设备）上最多同时进行的备份项数，避免机械硬盘来回寻道
+COPY_CHUNK_SIZE = 1024 * 1024  # 拷贝和压缩时每次读写的数据块大小，每块之间检查一次取消
+KERNEL_COPY_CHUNK_SIZE = 16 * 1024 * 1024  # copy_file_range/sendfile每次调用拷贝的字节数，每次调用之间检查取消
+USERSPACE_COPY_BUFFER_SIZE = 4 * 1024 * 1024  # 用户态拷贝的缓冲区大小
+FICLONE = 0x40049409  # Linux的reflink克隆ioctl，btrfs/XFS等支持写时复制的文件系统可用
+DEFLATE_WINDOW_SIZE = 32 * 1024  # DEFLATE的回溯窗口，并行压缩时每块用前面这么多数据作为字典
+# 压缩包中可选的压缩方式：名称 -> (zipfile的压缩类型, 压缩级别)，备份项的 compression 字段保存名称
+COMPRESSION_METHODS = {
+    'deflate': (zipfile.ZIP_DEFLATED, zlib.Z_DEFAULT_COMPRESSION),
+    'deflate_fast': (zipfile.ZIP_DEFLATED, 1),
+    'deflate_best': (zipfile.ZIP_DEFLATED, 9),
+    'bzip2': (zipfile.ZIP_BZIP2, 9),
+    'lzma': (zipfile.ZIP_LZMA, None),
+    'store': (zipfile.ZIP_STORED, None),
+}
+DEFAULT_COMPRESSION = 'deflate'
+# 已经压缩过的格式，再压缩几乎不会变小，直接存储
+INCOMPRESSIBLE_EXTENSIONS = frozenset((
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.heic', '.heif', '.avif', '.jxl',
+    '.mp4', '.m4v', '.mkv', '.mov', '.avi', '.webm', '.wmv', '.flv', '.ts',
+    '.mp3', '.m4a', '.aac', '.ogg', '.opus', '.flac', '.wma',
+    '.zip', '.7z', '.rar', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.cab',
+    '.docx', '.xlsx', '.pptx', '.odt', '.ods', '.odp', '.epub', '.jar', '.apk', '.whl',
+))
+COMPRESSIBILITY_SAMPLE_SIZE = 64 * 1024  # 扩展名未知的文件从中间抽样这么多字节试压缩
+COMPRESSIBILITY_SAMPLE_MIN_SIZE = 256 * 1024  # 小于这个大小的文件直接压缩，抽样省下的时间不如多读一次的开销
+INCOMPRESSIBLE_RATIO = 0.95  # 抽样压缩后仍有原大小的这个比例以上，就认为文件不可压缩
+WHOLE_FILE_SPOOL_SIZE = 64 * 1024 * 1024  # BZIP2/LZMA整文件压缩的结果超过这个大小时暂存到临时文件
+DELTA_COPY_MIN_SIZE = 64 * 1024 * 1024  # 增量拷贝模式下，不小于这个大小的文件只改写变化的数据块
+DELTA_BLOCK_SIZE = 1024 * 1024  # 增量拷贝比较和改写的块大小
+CHUNK_MIN_SIZE = 16 * 1024  # 去重块存储按内容切块的最小块大小
+CHUNK_MAX_SIZE = 256 * 1024  # 最大块大小，找不到内容边界时在这里切分；平均块大小约为64KB
+CHUNK_WINDOW_SIZE = 32  # 判断内容边界时使用的窗口大小
+CHUNK_COMPRESS_LEVEL = 1  # 块存储中的数据块用zlib压缩，级别低一些以免压缩成为瓶颈
+PACK_FILE_MAX_SIZE = 64 * 1024 * 1024  # 块存储的包文件写到这个大小后换一个新文件
+VERIFY_READ_SIZE = 8 * 1024 * 1024  # 校验时每次读取的字节数，读入复用的缓冲区
+VERIFY_RANGE_SIZE = 256 * 1024 * 1024  # 大文件按这个大小分段，各段由不同进程同时校验
+# 小文件和压缩包条目按源文件大小累计到这么多打包成一个校验任务，减少进程间传递任务的开销和重复打开压缩包
+VERIFY_BATCH_SIZE = 64 * 1024 * 1024
+VERIFY_BATCH_FILES = 1000  # 一个校验任务最多包含的文件数，大量空文件或极小的文件也能分到多个进程
+VERIFY_REPORT_PREFIX = "~备份工具校验报告_"  # 校验报告位于备份根目录下，文件名后接时间戳
+DEFAULT_POLL_INTERVAL = 30  # 监视模式下没有文件系统通知可用时，轮询扫描的间隔（秒）
+PROGRESS_REPORT_INTERVAL = 0.1  # 按字节统计的进度最多每隔这么多秒发一次进度事件
+THROUGHPUT_SMOOTHING_SECONDS = 10  # 估算剩余时间时，速度按这个时间常数做指数平滑
+LOG_FILE_NAME = "备份日志.jsonl"  # 界面备份时的完整日志，位于清单目录下，每行一个JSON
+LOG_FILE_MAX_BYTES = 10 * 1024 * 1024  # 日志文件超过这个大小就轮换
+LOG_FILE_BACKUPS = 5  # 轮换后保留的旧日志文件数，依次为 .1 到 .5
+METRICS_DIR_NAME = "性能统计"  # 开启性能统计时，每次备份的分阶段统计保存在清单目录下的这个目录中
+METRICS_SLOWEST_COUNT = 10  # 性能统计中列出的用时最长的文件数
+
+# 备份引擎发给界面或命令行的事件
+LogEvent = namedtuple('LogEvent', 'message')
+ProgressEvent = namedtuple('ProgressEvent', 'completed_size total_size active', defaults=((),))  # active为正在备份的源路径
+WarningEvent = namedtuple('WarningEvent', 'title message')
+MetricsEvent = namedtuple('MetricsEvent', 'path summary')  # 开启性能统计时备份结束前发出，path为统计文件
+FinishedEvent = namedtuple('FinishedEvent', 'canceled')
+
+
+class BackupCanceled(Exception):
+    # 用户取消备份时，在文件或数据块之间抛出
+    pass
+
+
+class PathRules:
+    # 备份目标的包含/排除规则（glob通配符），所有规则预先编译成一个正则，扫描时每个路径只匹配一次
+    # 不含'/'的规则匹配任意层级的文件名或目录名（如 node_modules、*.pyc），含'/'的规则匹配相对于源目录的路径（如 /build、docs/*.tmp）
+    # 以'/'结尾的规则只匹配目录；被排除的目录整个跳过，不再进入；包含规则只作用于文件，为空时包含全部文件
+
+    def __init__(self, include=(), exclude=()):
+        self.include_name, self.include_path, _, _ = self.compile(include)
+        self.exclude_name, self.exclude_path, self.exclude_dir_name, self.exclude_dir_path = self.compile(exclude)
+
+    @staticmethod
+    def compile(patterns):
+        # 返回 (文件名正则, 路径正则, 目录名正则, 目录路径正则)，没有对应规则时为None
+        groups = ([], [], [], [])
+        for pattern in patterns:
+            pattern = pattern.strip().replace('\\', '/')
+            dir_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            index = 1 if '/' in pattern else 0  # 开头的'/'表示只匹配源目录顶层
+            pattern = pattern.lstrip('/')
+            if not pattern:
+                continue
+            if not dir_only:
+                groups[index].append(fnmatch.translate(pattern))
+            groups[index + 2].append(fnmatch.translate(pattern))
+        return tuple(re.compile('|'.join(group)).match if group else None for group in groups)
+
+    @classmethod
+    def for_item(cls, item):
+        # 没有配置规则时返回None，扫描时不做任何匹配
+        if not item.get('include') and not item.get('exclude'):
+            return None
+        return cls(item.get('include', []), item.get('exclude', []))
+
+    def keep_dir(self, rel_path, name):
+        return not ((self.exclude_dir_name and self.exclude_dir_name(name)) or
+                    (self.exclude_dir_path and self.exclude_dir_path(rel_path)))
+
+    def keep_file(self, rel_path, name):
+        if (self.exclude_name and self.exclude_name(name)) or (self.exclude_path and self.exclude_path(rel_path)):
+            return False
+        if self.include_name is None and self.include_path is None:
+            return True
+        return bool((self.include_name and self.include_name(name)) or
+                    (self.include_path and self.include_path(rel_path)))
+
+    def keep_path(self, rel_path, is_dir=False):
+        # 单独检查一个路径：所在的各级目录都没有被排除，路径本身也符合规则
+        parts = rel_path.split('/')
+        for depth in range(1, len(parts)):
+            if not self.keep_dir('/'.join(parts[:depth]), parts[depth - 1]):
+                return False
+        if is_dir:
+            return self.keep_dir(rel_path, parts[-1])
+        return self.keep_file(rel_path, parts[-1])
+
+
+def walk_tree(source, rules=None, rel_dir='', need_inode=False, on_error=None, is_canceled=None):
+    # 所有目录遍历共用的遍历器：用os.scandir逐个目录读取，依次产生 (相对路径, [大小, 修改时间, inode])
+    # 文件类型来自目录项本身（Linux的d_type），不需要额外的stat；Windows上目录项自带大小和修改时间，
+    # DirEntry.stat()不再产生系统调用。与os.walk一样不进入指向目录的符号链接；rules排除的目录不会进入
+    # rel_dir为以os.sep结尾的子目录时只遍历这个子目录，产生的仍是相对于source的路径
+    # Windows上目录项的inode总是0，need_inode为True时（内容校验、镜像模式要用inode识别文件）再单独取一次
+    # 无法读取的目录与os.walk一样跳过，给出on_error时调用 on_error(相对目录, 异常)；读取时消失的文件直接跳过
+    # 给出is_canceled时每个目录之前检查一次取消，大目录树或网络位置的扫描也能及时停止
+    stack = [rel_dir]
+    while stack:
+        if is_canceled is not None and is_canceled():
+            raise BackupCanceled()
+        rel_dir = stack.pop()
+        try:
+            with os.scandir(os.path.join(source, rel_dir) if rel_dir else source) as it:
+                for entry in it:
+                    rel_path = rel_dir + entry.name
+                    rule_path = rel_path if os.sep == '/' else rel_path.replace(os.sep, '/')
+                    try:
+                        if entry.is_dir():
+                            if entry.is_symlink():
+                                continue
+                            if rules is None or rules.keep_dir(rule_path, entry.name):
+                                stack.append(rel_path + os.sep)
+                            continue
+                        if rules is not None and not rules.keep_file(rule_path, entry.name):
+                            continue
+                        st = entry.stat()
+                        inode = st.st_ino or (entry.inode() if need_inode else 0)
+                    except OSError:
+                        continue
+                    yield rel_path, [st.st_size, st.st_mtime, inode]
+        except OSError as e:
+            if on_error is not None:
+                on_error(rel_dir, e)
+
+
+def scan_tree(source, rules=None, need_inode=False, on_error=None, is_canceled=None):
+    # 一次遍历源目录（或单个文件），返回 相对路径 -> [大小, 修改时间, inode]；源不存在时返回None
+    # 大小统计、变更检测和拷贝计划都基于这次扫描，每个文件只stat一次
+    try:
+        st = os.stat(source)
+    except FileNotFoundError:
+        return None
+    if not stat.S_ISDIR(st.st_mode):
+        return {os.path.basename(source): [st.st_size, st.st_mtime, st.st_ino]}
+    return dict(walk_tree(source, rules, need_inode=need_inode, on_error=on_error, is_canceled=is_canceled))
+
+
+def rescan_paths(source, entries, dirty_paths, rules=None, need_inode=False, on_error=None, is_canceled=None):
+    # 监视模式：在上次的扫描结果上只重新stat发生变化的路径，返回新的 相对路径 -> [大小, 修改时间, inode]
+    # 变化的路径是目录时（新建、移入）重新扫描这个子目录；路径已不存在时删除它以及它下面的条目
+    entries = dict(entries)
+    for rel_path in dirty_paths:
+        try:
+            st = os.stat(os.path.join(source, rel_path))
+        except (FileNotFoundError, NotADirectoryError):
+            if entries.pop(rel_path, None) is None:
+                # 可能是被删除或移走的目录
+                prefix = rel_path + os.sep
+                for key in [key for key in entries if key.startswith(prefix)]:
+                    del entries[key]
+            continue
+        except OSError:
+            continue  # 暂时无法访问，保留上次的条目
+        rule_path = rel_path if os.sep == '/' else rel_path.replace(os.sep, '/')
+        if stat.S_ISDIR(st.st_mode):
+            if rules is None or rules.keep_path(rule_path, is_dir=True):
+                entries.update(walk_tree(source, rules, rel_path + os.sep, need_inode, on_error, is_canceled))
+        elif rules is None or rules.keep_path(rule_path):
+            entries[rel_path] = [st.st_size, st.st_mtime, st.st_ino]
+    return entries
+
+
+class PollingWatcher:
+    # 监视模式的后备方案：定期重新扫描各备份目标，和上次的结果比较得到变化的路径
+    # 只做stat不拷贝，每次的代价和目录树大小成正比，所以间隔较长
+
+    def __init__(self, backup_items, interval=DEFAULT_POLL_INTERVAL):
+        self.backup_items = backup_items
+        self.interval = interval
+        self.scans = {item['path']: self.scan(item) for item in backup_items}
+        self.next_poll = time.monotonic() + interval
+
+    @staticmethod
+    def scan(item):
+        return scan_tree(item['path'], PathRules.for_item(item)) or {}
+
+    def wait(self, timeout):
+        # 最多等待timeout秒，返回 {备份目标路径: 变化的相对路径集合}，没有变化时返回空字典
+        delay = self.next_poll - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return {}
+        time.sleep(max(delay, 0))
+        self.next_poll = time.monotonic() + self.interval
+        changes = {}
+        for item in self.backup_items:
+            old, new = self.scans[item['path']], self.scan(item)
+            dirty = {rel_path for rel_path, entry in new.items() if old.get(rel_path) != entry}
+            dirty.update(rel_path for rel_path in old if rel_path not in new)
+            self.scans[item['path']] = new
+            if dirty:
+                changes[item['path']] = dirty
+        return changes
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher:
+    # Linux上用inotify订阅文件变化，变化发生后立即得到具体路径，不需要扫描整个目录树
+    # 每个目录一个watch，新建的子目录自动加入；内核事件队列溢出时把整个目标标记为需要完整扫描（值为None）
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE |
+                  IN_DELETE_SELF | IN_MOVE_SELF)
+    EVENT_HEADER = struct.Struct('iIII')
+
+    def __init__(self, backup_items):
+        # 不是Linux或inotify不可用时抛出OSError，调用者改用轮询
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, "inotify只在Linux上可用")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1失败")
+        # watch描述符 -> [(备份项, 相对目录，以os.sep结尾或为空), ...]；同一目录再次添加watch时内核返回同一个描述符，
+        # 例如同一目录下的两个单文件目标、目录目标中的单文件目标，所以一个描述符可能属于多个备份项
+        self.watches = {}
+        self.overflowed = set()  # 添加watch失败或事件丢失、需要完整扫描的备份目标
+        self.rules = {item['path']: PathRules.for_item(item) for item in backup_items}
+        try:
+            for item in backup_items:
+                if item['is_dir']:
+                    self.add_tree(item, '')
+                else:
+                    # 单个文件目标监视所在目录，只关心这个文件名
+                    self.add_watch(item, os.path.dirname(item['path']), '')
+        except BaseException:
+            self.close()
+            raise
+
+    def add_watch(self, item, dir_path, rel_dir):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(dir_path), self.WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                raise OSError(error, "inotify的watch数量达到上限（fs.inotify.max_user_watches）")
+            return False  # 目录已经不存在或没有权限
+        owners = self.watches.setdefault(wd, [])
+        if (item, rel_dir) not in owners:
+            owners.append((item, rel_dir))
+        return True
+
+    def add_tree(self, item, rel_dir):
+        # 监视目录和它下面所有未被排除的子目录，rel_dir本身由调用者检查
+        rules = self.rules[item['path']]
+        source = item['path']
+        stack = [rel_dir]
+        while stack:
+            rel_dir = stack.pop()
+            dir_path = os.path.join(source, rel_dir) if rel_dir else source
+            if not self.add_watch(item, dir_path, rel_dir):
+                continue
+            try:
+                with os.scandir(dir_path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            rel_path = rel_dir + entry.name
+                            rule_path = rel_path if os.sep == '/' else rel_path.replace(os.sep, '/')
+                            if rules is None or rules.keep_dir(rule_path, entry.name):
+                                stack.append(rel_path + os.sep)
+            except OSError:
+                continue
+
+    def wait(self, timeout):
+        # 最多等待timeout秒，返回 {备份目标路径: 变化的相对路径集合或None}
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        changes = {path: None for path in self.overflowed}
+        self.overflowed.clear()
+        if not readable:
+            return changes
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, name_length = self.EVENT_HEADER.unpack_from(data, offset)
+                offset += self.EVENT_HEADER.size
+                name = os.fsdecode(data[offset:offset + name_length].rstrip(b'\0'))
+                offset += name_length
+                if mask & self.IN_Q_OVERFLOW:
+                    for owners in self.watches.values():
+                        for item, _ in owners:
+                            changes[item['path']] = None
+                    continue
+                if wd not in self.watches:
+                    continue
+                if mask & self.IN_IGNORED:
+                    del self.watches[wd]  # 目录被删除，内核已经移除了watch
+                    continue
+                if not name:
+                    continue  # 被监视的目录自身的事件，父目录的事件已经覆盖
+                # 事件分发给这个目录的每个所属备份项；遍历副本，add_tree可能给同一描述符添加所属项
+                for item, rel_dir in list(self.watches[wd]):
+                    self.dispatch(changes, item, rel_dir, name, mask)
+        return changes
+
+    def dispatch(self, changes, item, rel_dir, name, mask):
+        # 把目录rel_dir下名为name的变化记入备份项item
+        if not item['is_dir']:
+            if name != os.path.basename(item['path']):
+                return
+            rel_path = name
+        else:
+            rel_path = rel_dir + name
+            # 被排除的路径（包括启动后才新建的被排除目录）既不监视，也不触发备份
+            rules = self.rules[item['path']]
+            rule_path = rel_path if os.sep == '/' else rel_path.replace(os.sep, '/')
+            if rules is not None and not rules.keep_path(rule_path, is_dir=bool(mask & self.IN_ISDIR)):
+                return
+            if mask & self.IN_ISDIR and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                try:
+                    self.add_tree(item, rel_path + os.sep)
+                except OSError:
+                    self.overflowed.add(item['path'])
+        dirty = changes.setdefault(item['path'], set())
+        if dirty is not None:
+            dirty.add(rel_path)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def create_watcher(backup_items, poll_interval=DEFAULT_POLL_INTERVAL):
+    # 优先使用文件系统通知，不可用时退回到轮询扫描；返回 (监视器, 说明)
+    try:
+        return InotifyWatcher(backup_items), "inotify"
+    except (OSError, AttributeError) as e:
+        return PollingWatcher(backup_items, poll_interval), f"轮询（每 {poll_interval} 秒扫描一次，{e}）"
+
+
+def new_content_hasher():
+    # 内容校验使用的快速摘要
+    return hashlib.blake2b(digest_size=16)
+
+
+def file_digest(file_path, is_canceled):
+    # 分块计算文件内容摘要，每个数据块之间检查取消
+    hasher = new_content_hasher()
+    with open(file_path, 'rb') as file:
+        while True:
+            if is_canceled():
+                raise BackupCanceled()
+            chunk = file.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+NULL_MEASURE = contextlib.nullcontext()  # 没有开启性能统计时使用，不计时
+
+
+def null_measure(*args, **kwargs):
+    return NULL_MEASURE
+
+
+# 各拷贝方式在每个数据块之后检查取消，并把拷贝的字节数报告给progress（可为None）
+
+def _copy_reflink(src_fd, dst_fd, is_canceled, progress=None):
+    fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    copied = os.fstat(dst_fd).st_size
+    if progress is not None:
+        progress(copied)
+    return copied
+
+
+def _copy_file_range(src_fd, dst_fd, is_canceled, progress=None):
+    copied = 0
+    while True:
+        if is_canceled():
+            raise BackupCanceled()
+        sent = os.copy_file_range(src_fd, dst_fd, KERNEL_COPY_CHUNK_SIZE)
+        if sent == 0:
+            return copied
+        copied += sent
+        if progress is not None:
+            progress(sent)
+
+
+def _copy_sendfile(src_fd, dst_fd, is_canceled, progress=None):
+    copied = 0
+    while True:
+        if is_canceled():
+            raise BackupCanceled()
+        sent = os.sendfile(dst_fd, src_fd, None, KERNEL_COPY_CHUNK_SIZE)
+        if sent == 0:
+            return copied
+        copied += sent
+        if progress is not None:
+            progress(sent)
+
+
+def _copy_userspace(src_raw, dst_fd, is_canceled, hasher=None, progress=None):
+    # src_raw为不带缓冲的源文件对象（FileIO），从描述符当前位置直接读入复用的缓冲区；各系统都可用
+    copied = 0
+    buffer = bytearray(USERSPACE_COPY_BUFFER_SIZE)
+    view = memoryview(buffer)
+    while True:
+        if is_canceled():
+            raise BackupCanceled()
+        length = src_raw.readinto(view)
+        if length == 0:
+            return copied
+        written = 0
+        while written < length:
+            written += os.write(dst_fd, view[written:length])
+        if hasher is not None:
+            hasher.update(view[:length])
+        copied += length
+        if progress is not None:
+            progress(length)
+
+
+def delta_copy(source, destination, old_digests, is_canceled, hasher=None, progress=None):
+    # 大文件增量拷贝：按固定大小的块比较源和已有的目标文件，只在原位改写有变化的块，最后截断到源的大小
+    # 虚拟机镜像、数据库等文件都是原位修改，固定偏移的块就能找出变化；old_digests为目标各块的摘要（来自缓存），
+    # 为None时读取目标文件直接比较。返回 (改写的字节数, 源各块的摘要)
+    digests = []
+    written = 0
+    with open(source, 'rb') as fsrc, open(destination, 'r+b') as fdst:
+        offset = 0
+        while True:
+            if is_canceled():
+                raise BackupCanceled()
+            block = fsrc.read(DELTA_BLOCK_SIZE)
+            if not block:
+                break
+            digest = new_content_hasher()
+            digest.update(block)
+            digest = digest.hexdigest()
+            if hasher is not None:
+                hasher.update(block)
+            index = len(digests)
+            if old_digests is not None:
+                changed = index >= len(old_digests) or old_digests[index] != digest
+            else:
+                fdst.seek(offset)
+                changed = fdst.read(len(block)) != block
+            if changed:
+                fdst.seek(offset)
+                fdst.write(block)
+                written += len(block)
+            digests.append(digest)
+            offset += len(block)
+            if progress is not None:
+                progress(len(block))
+        fdst.truncate(offset)
+    shutil.copystat(source, destination)
+    return written, digests
+
+
+# 内容切块的触发字节：按固定的摘要选出约1/12的字节值，只在连续两个触发字节处检查窗口摘要，
+# 查找和映射都由bytes的C实现完成，比逐字节计算滚动哈希快一个数量级；表是固定的，切块结果在任何机器上都相同
+CHUNK_TRIGGER_TABLE = bytes(1 if hashlib.blake2b(bytes([value]), digest_size=1).digest()[0] < 16 else 0
+                            for value in range(256))
+
+
+def find_chunk_boundary(data, marks, start, end):
+    # 返回从start开始的第一个块的结束位置：从CHUNK_MIN_SIZE起找内容决定的边界，找不到时在CHUNK_MAX_SIZE处切分
+    # marks是data逐字节经CHUNK_TRIGGER_TABLE映射的结果，end为data中有效数据的结尾
+    # 边界只取决于附近的内容，文件中插入或删除数据后，其余部分切出的块不变，可以去重
+    end = min(end, start + CHUNK_MAX_SIZE)
+    if end - start <= CHUNK_MIN_SIZE:
+        return end
+    position = marks.find(b'\x01\x01', start + CHUNK_MIN_SIZE - 2, end)
+    while position != -1:
+        cut = position + 2
+        if zlib.crc32(data[cut - CHUNK_WINDOW_SIZE:cut]) & 0xFF == 0:
+            return cut
+        position = marks.find(b'\x01\x01', position + 1, end)
+    return end
+
+
+def iter_file_chunks(file_path, is_canceled):
+    # 按内容切块依次产出文件的数据块，每块之间检查取消
+    # 缓冲区里用start记录已产出的位置，只在剩余数据不足一个最大块、需要读入时才丢掉前面的部分，
+    # 字节映射也只对新读入的数据做一次，不随每个块重复拷贝整个缓冲区
+    buffer = bytearray()
+    marks = bytearray()
+    start = 0
+    with open(file_path, 'rb') as file:
+        eof = False
+        while True:
+            if not eof and len(buffer) - start < CHUNK_MAX_SIZE:
+                del buffer[:start]
+                del marks[:start]
+                start = 0
+                while not eof and len(buffer) < CHUNK_MAX_SIZE:
+                    data = file.read(COPY_CHUNK_SIZE)
+                    eof = not data
+                    buffer += data
+                    marks += data.translate(CHUNK_TRIGGER_TABLE)
+            if start == len(buffer):
+                return
+            if is_canceled():
+                raise BackupCanceled()
+            with memoryview(buffer) as view:
+                cut = find_chunk_boundary(view, marks, start, len(buffer))
+                chunk = bytes(view[start:cut])
+            yield chunk
+            start = cut
+
+
+class CopyBackend:
+    # 文件拷贝后端：依次尝试 reflink克隆 -> copy_file_range -> sendfile -> 大缓冲区用户态拷贝
+    # 按 (源设备, 目标设备) 记住不支持的方式，之后同一对文件系统直接跳过；可在多个拷贝线程中共用
+    # 统计每种方式拷贝的文件数、字节数和耗时，供备份日志汇报
+
+    STRATEGIES = ('reflink', 'copy_file_range', 'sendfile', 'userspace')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.unsupported = {}  # (源设备, 目标设备) -> 不可用的方式集合
+        self.stats = {}  # 方式 -> [文件数, 字节数, 耗时]
+        self.delta_stats = [0, 0, 0, 0.0]  # 增量拷贝的 [文件数, 比较的字节数, 改写的字节数, 耗时]
+        self.unsupported_everywhere = set()
+        if fcntl is None:
+            self.unsupported_everywhere.add('reflink')
+        if not hasattr(os, 'copy_file_range'):
+            self.unsupported_everywhere.add('copy_file_range')
+        if not sys.platform.startswith('linux'):
+            # 其他系统上sendfile不支持普通文件作为输出
+            self.unsupported_everywhere.add('sendfile')
+
+    def copy(self, source, destination, is_canceled, hasher=None, progress=None):
+        # 拷贝文件内容并保留元数据，返回实际使用的方式；取消或出错时删除不完整的目标文件
+        # 需要同时计算摘要时数据必须经过用户态，直接使用用户态拷贝；progress在每个数据块后收到拷贝的字节数
+        try:
+            with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+                src_fd = fsrc.fileno()
+                dst_fd = fdst.fileno()
+                src_st = os.fstat(src_fd)
+                devices = (src_st.st_dev, os.fstat(dst_fd).st_dev)
+                for strategy in self.STRATEGIES:
+                    if strategy != 'userspace' and (hasher is not None or self.is_unsupported(devices, strategy)):
+                        continue
+                    start = time.perf_counter()
+                    try:
+                        if strategy == 'reflink':
+                            copied = _copy_reflink(src_fd, dst_fd, is_canceled, progress)
+                        elif strategy == 'copy_file_range':
+                            copied = _copy_file_range(src_fd, dst_fd, is_canceled, progress)
+                        elif strategy == 'sendfile':
+                            copied = _copy_sendfile(src_fd, dst_fd, is_canceled, progress)
+                        else:
+                            copied = _copy_userspace(fsrc.raw, dst_fd, is_canceled, hasher, progress)
+                    except OSError as e:
+                        # 空间不足等错误换方式也没用；已经写入了部分数据时也不再回退
+                        if (strategy == 'userspace' or e.errno in (errno.ENOSPC, errno.EDQUOT)
+                                or os.lseek(dst_fd, 0, os.SEEK_CUR) != 0):
+                            raise
+                        self.mark_unsupported(devices, strategy)
+                        os.lseek(src_fd, 0, os.SEEK_SET)
+                        continue
+                    if strategy != 'userspace' and copied < src_st.st_size:
+                        # 内核拷贝没有报错却什么也没拷贝或者没拷贝完（伪文件、部分FUSE/网络文件系统），
+                        # 这对文件系统不再使用这种方式，清空目标从头改用下一种方式
+                        self.mark_unsupported(devices, strategy)
+                        if progress is not None and copied:
+                            progress(-copied)
+                        os.ftruncate(dst_fd, 0)
+                        os.lseek(dst_fd, 0, os.SEEK_SET)
+                        os.lseek(src_fd, 0, os.SEEK_SET)
+                        continue
+                    self.record(strategy, copied, time.perf_counter() - start)
+                    break
+        except BaseException:
+            if os.path.exists(destination):
+                os.remove(destination)
+            raise
+        shutil.copystat(source, destination)
+        return strategy
+
+    def is_unsupported(self, devices, strategy):
+        if strategy in self.unsupported_everywhere:
+            return True
+        with self.lock:
+            return strategy in self.unsupported.get(devices, ())
+
+    def mark_unsupported(self, devices, strategy):
+        with self.lock:
+            self.unsupported.setdefault(devices, set()).add(strategy)
+
+    def record(self, strategy, copied, seconds):
+        with self.lock:
+            stats = self.stats.setdefault(strategy, [0, 0, 0.0])
+            stats[0] += 1
+            stats[1] += copied
+            stats[2] += seconds
+
+    def record_delta(self, compared, written, seconds):
+        with self.lock:
+            self.delta_stats[0] += 1
+            self.delta_stats[1] += compared
+            self.delta_stats[2] += written
+            self.delta_stats[3] += seconds
+
+    def summary(self):
+        # 每种方式一行：文件数、总量和平均速度
+        lines = []
+        with self.lock:
+            for strategy in self.STRATEGIES:
+                if strategy not in self.stats:
+                    continue
+                files, copied, seconds = self.stats[strategy]
+                speed = copied / seconds / 1024 ** 2 if seconds > 0 else 0
+                lines.append(f"拷贝方式 {strategy}：{files} 个文件，{copied / 1024 ** 2:.2f}MB，{speed:.1f}MB/s")
+            files, compared, written, seconds = self.delta_stats
+            if files:
+                speed = compared / seconds / 1024 ** 2 if seconds > 0 else 0
+                lines.append(f"增量拷贝：{files} 个文件，比较 {compared / 1024 ** 2:.2f}MB，"
+                             f"只改写了 {written / 1024 ** 2:.2f}MB，{speed:.1f}MB/s")
+        return lines
+
+
+def strip_zip64_extra(extra):
+    # 去掉extra中的ZIP64扩展字段（id为1），写入新压缩包时由zipfile按新的偏移和大小重新生成
+    result = b''
+    i = 0
+    while i + 4 <= len(extra):
+        field_id, size = struct.unpack('<HH', extra[i:i + 4])
+        if field_id != 1:
+            result += extra[i:i + 4 + size]
+        i += 4 + size
+    return result
+
+
+def copy_raw_zip_entry(old_file, old_info, zipf, is_canceled):
+    # 把旧压缩包中的一个条目按原样（不解压也不重新压缩）拷贝到正在写入的压缩包zipf
+    # old_file是以二进制方式打开的旧压缩包，old_info是该条目在中央目录中的信息
+    old_file.seek(old_info.header_offset)
+    header = old_file.read(zipfile.sizeFileHeader)
+    if header[:4] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"条目 {old_info.filename} 的本地文件头损坏")
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    old_file.seek(old_info.header_offset + zipfile.sizeFileHeader + name_length + extra_length)
+
+    zinfo = copy.copy(old_info)
+    zinfo.extra = strip_zip64_extra(old_info.extra)
+    zinfo.flag_bits &= ~0x08  # 大小和CRC已知，直接写在本地文件头里，不再需要数据描述符
+    zipf.fp.seek(zipf.start_dir)
+    zinfo.header_offset = zipf.fp.tell()
+    zipf.fp.write(zinfo.FileHeader())
+    remaining = old_info.compress_size
+    while remaining > 0:
+        if is_canceled():
+            raise BackupCanceled()
+        chunk = old_file.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f"条目 {old_info.filename} 的数据不完整")
+        zipf.fp.write(chunk)
+        remaining -= len(chunk)
+    # 与zipfile自己写完一个条目后的处理相同，中央目录在关闭时统一写出
+    zipf.start_dir = zipf.fp.tell()
+    zipf.filelist.append(zinfo)
+    zipf.NameToInfo[zinfo.filename] = zinfo
+
+
+def _gf2_matrix_times(matrix, vector):
+    result = 0
+    i = 0
+    while vector:
+        if vector & 1:
+            result ^= matrix[i]
+        vector >>= 1
+        i += 1
+    return result
+
+
+@functools.lru_cache(maxsize=64)
+def _crc32_zeros_operator(length):
+    # 在CRC32后追加length个零字节对应的GF(2)线性变换，按列（基向量的像）保存，原理同zlib的crc32_combine
+    operator = [1 << n for n in range(32)]
+    power = [0xedb88320] + [1 << n for n in range(31)]  # 追加一个零比特
+    bits = length * 8
+    while bits:
+        if bits & 1:
+            operator = [_gf2_matrix_times(power, column) for column in operator]
+        bits >>= 1
+        if bits:
+            power = [_gf2_matrix_times(power, column) for column in power]
+    return operator
+
+
+def crc32_combine(crc1, crc2, length2):
+    # 已知两段数据各自的CRC32，求拼接后的CRC32，length2是第二段的长度
+    return _gf2_matrix_times(_crc32_zeros_operator(length2), crc1) ^ crc2
+
+
+def is_incompressible(file_path, size):
+    # 按扩展名判断，未知扩展名的较大文件从中间抽样，用最快的级别试压缩，几乎不变小说明内容已经压缩或加密过
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    if size < COMPRESSIBILITY_SAMPLE_MIN_SIZE:
+        return False
+    try:
+        with open(file_path, 'rb') as file:
+            file.seek((size - COMPRESSIBILITY_SAMPLE_SIZE) // 2)  # 跳过文件头，头部常是可压缩的元数据
+            sample = file.read(COMPRESSIBILITY_SAMPLE_SIZE)
+    except OSError:
+        return False
+    return len(zlib.compress(sample, 1)) >= len(sample) * INCOMPRESSIBLE_RATIO
+
+
+class CompressionPolicy:
+    # 压缩包中每个文件的压缩方式：已经压缩过的内容直接存储，其余按备份项选择的方式压缩
+    # 备份项字段：compression 为 COMPRESSION_METHODS 中的名称，store_incompressible 为False时不做判断
+
+    def __init__(self, method=DEFAULT_COMPRESSION, store_incompressible=True):
+        self.method = method if method in COMPRESSION_METHODS else DEFAULT_COMPRESSION
+        self.compress_type, self.level = COMPRESSION_METHODS[self.method]
+        self.store_incompressible = store_incompressible and self.compress_type != zipfile.ZIP_STORED
+        self.stored_count = 0  # 判断为不可压缩、直接存储的文件数
+
+    def settings(self):
+        # 记入清单的压缩设置，与上次不同时压缩包中的旧条目不能复用
+        return [self.method, self.store_incompressible]
+
+    @classmethod
+    def for_item(cls, item):
+        return cls(item.get('compression', DEFAULT_COMPRESSION), item.get('store_incompressible', True))
+
+    def choose(self, file_path, size):
+        # 返回 (压缩类型, 压缩级别)
+        if self.store_incompressible and is_incompressible(file_path, size):
+            self.stored_count += 1
+            return zipfile.ZIP_STORED, None
+        return self.compress_type, self.level
+
+
+def store_block(file_path, offset, length, is_last, level, keep_data=False):
+    # 不压缩的数据块：与deflate_block返回相同的结构，原样存储
+    with open(file_path, 'rb') as file:
+        file.seek(offset)
+        data = file.read(length)
+    return data, zlib.crc32(data), len(data), data if keep_data else None
+
+
+def compress_whole_file(file_path, compress_type, level, keep_data, is_canceled):
+    # BZIP2和LZMA的数据流不能分块压缩后拼接，整个文件在一个压缩线程中压缩，不同文件仍然并行
+    # 压缩结果暂存在内存，较大时转存到临时文件；keep_data为True时返回内容摘要的hasher，代替原始数据
+    compressor = zipfile._get_compressor(compress_type, level)
+    output = tempfile.SpooledTemporaryFile(max_size=WHOLE_FILE_SPOOL_SIZE)
+    hasher = new_content_hasher() if keep_data else None
+    crc = 0
+    length = 0
+    try:
+        with open(file_path, 'rb') as file:
+            while True:
+                if is_canceled():
+                    raise BackupCanceled()
+                data = file.read(COPY_CHUNK_SIZE)
+                if not data:
+                    break
+                crc = zlib.crc32(data, crc)
+                length += len(data)
+                if hasher is not None:
+                    hasher.update(data)
+                output.write(compressor.compress(data))
+        output.write(compressor.flush())
+    except BaseException:
+        output.close()
+        raise
+    output.seek(0)
+    return output, crc, length, hasher
+
+
+def deflate_block(file_path, offset, length, is_last, level, keep_data=False):
+    # 在压缩线程中执行：读取文件的一个数据块并独立压缩成原始DEFLATE数据
+    # 以块前32KB数据作为预设字典，压缩率与整体压缩基本一致；非最后一块以同步刷新结尾，按字节对齐，可直接拼接
+    # keep_data为True时一并返回原始数据，供写入方按顺序计算内容摘要
+    with open(file_path, 'rb') as file:
+        dict_start = max(0, offset - DEFLATE_WINDOW_SIZE)
+        file.seek(dict_start)
+        zdict = file.read(offset - dict_start)
+        data = file.read(length)
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if is_last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.crc32(data), len(data), data if keep_data else None
+
+
+class ParallelZipWriter:
+    # 多线程写入压缩包：压缩线程各自压缩文件的数据块（zlib压缩时释放GIL，线程即可用满多核），
+    # 由调用线程按条目顺序把结果拼成标准的DEFLATE数据流写入zipf，输出与线程数和完成顺序无关
+    # 每个文件的压缩方式由policy决定：直接存储的文件同样分块并行读取，BZIP2/LZMA整个文件作为一块
+    # 同时在途的数据块数有上限，超大文件也只占用有限内存；ZIP64由zipfile按大小自动启用
+    # hash_files为True时顺便计算每个新压缩文件的内容摘要，结果在digests中（条目名 -> 摘要）
+    # 每写入一个数据块把它的原始字节数报告给progress（可为None）
+
+    def __init__(self, zipf, workers, is_canceled, policy=None, hash_files=False, progress=None):
+        self.zipf = zipf
+        self.workers = max(1, workers)
+        self.is_canceled = is_canceled
+        self.policy = policy if policy is not None else CompressionPolicy(store_incompressible=False)
+        self.max_pending = self.workers * 2
+        self.hash_files = hash_files
+        self.progress = progress
+        self.digests = {}
+
+    def iter_blocks(self, tasks):
+        # 按顺序产出待压缩文件的全部数据块：(条目信息, 文件路径, 偏移, 长度, 是否最后一块, 压缩级别)
+        for task in tasks:
+            if task[0] != 'compress':
+                continue
+            zinfo = zipfile.ZipInfo.from_file(task[1], task[2])
+            # 写入方在写这个文件时会重置zinfo里的大小，这里按扫描时的大小切块
+            file_size = zinfo.file_size
+            zinfo.compress_type, level = self.policy.choose(task[1], file_size)
+            if zinfo.compress_type == zipfile.ZIP_LZMA:
+                zinfo.flag_bits |= 0x02  # 与zipfile相同：LZMA数据以结束标记结尾
+            if zinfo.compress_type in (zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA):
+                yield zinfo, task[1], 0, file_size, True, level
+                continue
+            offset = 0
+            while True:
+                length = min(COPY_CHUNK_SIZE, file_size - offset)
+                is_last = offset + length >= file_size
+                yield zinfo, task[1], offset, length, is_last, level
+                if is_last:
+                    break
+                offset += length
+
+    def write(self, tasks, old_file=None):
+        # tasks按条目顺序给出：('copy', 旧条目信息) 从old_file原样拷贝，('compress', 文件路径, 条目名) 重新压缩
+        blocks = self.iter_blocks(tasks)
+        pending = deque()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        def next_block():
+            # 补足在途的数据块后，按提交顺序取出下一块的压缩结果
+            while len(pending) < self.max_pending:
+                block = next(blocks, None)
+                if block is None:
+                    break
+                zinfo, file_path, offset, length, is_last, level = block
+                if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+                    future = executor.submit(deflate_block, file_path, offset, length, is_last, level, self.hash_files)
+                elif zinfo.compress_type == zipfile.ZIP_STORED:
+                    future = executor.submit(store_block, file_path, offset, length, is_last, level, self.hash_files)
+                else:
+                    future = executor.submit(compress_whole_file, file_path, zinfo.compress_type, level,
+                                             self.hash_files, self.is_canceled)
+                pending.append((zinfo, is_last, future))
+            zinfo, is_last, future = pending.popleft()
+            return (zinfo, is_last) + future.result()
+
+        try:
+            for task in tasks:
+                if self.is_canceled():
+                    raise BackupCanceled()
+                if task[0] == 'copy':
+                    copy_raw_zip_entry(old_file, task[1], self.zipf, self.is_canceled)
+                else:
+                    self.write_compressed_entry(next_block)
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            # 已经完成但没有写入的整文件压缩结果可能是临时文件，关闭以删除
+            for _, _, future in pending:
+                if future.done() and not future.cancelled() and future.exception() is None:
+                    compressed = future.result()[0]
+                    if not isinstance(compressed, bytes):
+                        compressed.close()
+
+    def write_compressed_entry(self, next_block):
+        # 写入一个文件的全部压缩块，写完后回填本地文件头中的CRC和大小
+        zipf = self.zipf
+        zinfo, is_last, compressed, crc, length, data = next_block()
+        hasher = new_content_hasher() if self.hash_files else None
+        zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT  # 与zipfile相同的判断，预留压缩后变大的余量
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        zipf.fp.seek(zipf.start_dir)
+        zinfo.header_offset = zipf.fp.tell()
+        zipf.fp.write(zinfo.FileHeader(zip64))  # 先写占位的文件头，大小按扫描时的值
+        zinfo.file_size = 0
+        while True:
+            if isinstance(compressed, bytes):
+                zipf.fp.write(compressed)
+                zinfo.compress_size += len(compressed)
+            else:
+                # 整文件压缩的结果，data是压缩线程算好的内容摘要
+                with compressed:
+                    shutil.copyfileobj(compressed, zipf.fp, COPY_CHUNK_SIZE)
+                    zinfo.compress_size += compressed.tell()
+                if hasher is not None:
+                    hasher = data
+                    data = b''
+            zinfo.CRC = crc32_combine(zinfo.CRC, crc, length)
+            zinfo.file_size += length
+            if hasher is not None:
+                hasher.update(data)
+            if self.progress is not None:
+                self.progress(length)
+            if is_last:
+                break
+            if self.is_canceled():
+                raise BackupCanceled()
+            _, is_last, compressed, crc, length, data = next_block()
+        if not zip64 and max(zinfo.file_size, zinfo.compress_size) > zipfile.ZIP64_LIMIT:
+            raise RuntimeError(f"文件 {zinfo.filename} 压缩后超过了非ZIP64条目的大小上限")
+        end = zipf.fp.tell()
+        zipf.fp.seek(zinfo.header_offset)
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        zipf.fp.seek(end)
+        zipf.start_dir = end
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+        if hasher is not None:
+            self.digests[zinfo.filename] = hasher.hexdigest()
+
+
+def move_into_recycle_bin(target, recycle_bin, backup_root, dest_index=None):
+    # 把备份根目录下的target按相对路径移入回收站，出错时抛出异常；可在多个拷贝线程中同时调用
+    # 回收站和备份在同一个卷上，移动只是一次改名，不拷贝数据；target在另外挂载的卷上时才退回到拷贝后删除，
+    # 备份开始时会对这样的备份目标给出提示。给出dest_index（网络目标模式）时，回收站中已经创建过的目录不再重复创建
+    target_in_bin = os.path.join(recycle_bin, os.path.relpath(target, start=backup_root))
+    if dest_index is not None:
+        dest_index.makedirs(os.path.dirname(target_in_bin))
+    else:
+        os.makedirs(os.path.dirname(target_in_bin), exist_ok=True)
+    try:
+        os.replace(target, target_in_bin)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(target, target_in_bin)
+    if dest_index is not None:
+        dest_index.discard(target)
+
+
+def directory_size(path):
+    # 目录下所有文件的总大小和文件数，不跟随符号链接
+    size = 0
+    files = 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            size += entry.stat(follow_symlinks=False).st_size
+                            files += 1
+                    except OSError:
+                        continue
+        except OSError:
+            continue
+    return size, files
+
+
+class RecycleBinIndex:
+    # 回收站索引：回收站目录名 -> {'time': 创建时间, 'size': 总大小, 'files': 文件数}
+    # 每次备份结束时只统计本次的回收站，其余回收站的大小取自索引；索引中没有的回收站（旧版本留下的，或索引丢失）
+    # 统计一次后记入，手动删除了的回收站从索引中去掉。按保留天数和总大小上限从最旧的回收站开始删除
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.bins = {}
+
+    @classmethod
+    def load(cls, path):
+        index = cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return index
+        if data.get('version') == cls.VERSION:
+            index.bins = data.get('bins', {})
+        return index
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'version': self.VERSION, 'bins': self.bins}, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)
+
+    def add(self, bin_path):
+        # 统计回收站的大小并记入索引
+        size, files = directory_size(bin_path)
+        name = os.path.basename(bin_path)
+        try:
+            created = datetime.strptime(name[len(RECYCLE_BIN_PREFIX):], "%Y%m%d_%H%M%S").timestamp()
+        except ValueError:
+            created = os.stat(bin_path).st_mtime
+        self.bins[name] = {'time': created, 'size': size, 'files': files}
+
+    def sync(self, backup_root):
+        # 与备份根目录下实际存在的回收站对齐，只需列一次备份根目录
+        present = {name for name in os.listdir(backup_root)
+                   if name.startswith(RECYCLE_BIN_PREFIX) and os.path.isdir(os.path.join(backup_root, name))}
+        for name in set(self.bins) - present:
+            del self.bins[name]
+        for name in sorted(present - set(self.bins)):
+            self.add(os.path.join(backup_root, name))
+
+    def total_size(self):
+        return sum(info['size'] for info in self.bins.values())
+
+    def expired(self, max_size, max_age, keep, now):
+        # 按保留策略需要删除的回收站名，从最旧的开始；keep（本次备份的回收站）不删除。max_size、max_age为0表示不限
+        expired = []
+        total = self.total_size()
+        for name, info in sorted(self.bins.items(), key=lambda item: item[1]['time']):
+            if name == keep:
+                continue
+            if (max_age and now - info['time'] > max_age) or (max_size and total > max_size):
+                expired.append(name)
+                total -= info['size']
+        return expired
+
+
+def list_directory(path):
+    # 列出一个目录，返回 (文件路径列表, 子目录路径列表)；只用目录项的类型，不stat；目录不存在时返回None
+    files = []
+    dirs = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    return files, dirs
+
+
+class DestinationIndex:
+    # 网络目标模式（NAS/SMB等每次文件操作都是一次网络往返的备份根目录）：登记过的目标目录在第一次用到时
+    # 整体并行列一次，之后“文件是否存在”“目录是否已创建”都从内存回答，不再逐个文件往返
+    # 本次备份创建、移走的文件和目录同步记入；没有登记的路径照常查询文件系统。可在多个拷贝线程中同时使用
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = set()
+        self.dirs = set()
+        self.roots = {}  # 登记的目标目录 -> 是否已经列过
+
+    def register(self, root):
+        with self.lock:
+            self.roots.setdefault(root, False)
+
+    def covering_root(self, path):
+        # path所在的已登记目标目录，需要时先列出它；不在任何登记的目录下时返回None
+        for root in list(self.roots):  # 其他备份目标可能同时在登记
+            if path == root or path.startswith(root + os.sep):
+                with self.lock:
+                    if not self.roots[root]:
+                        self.load(root)
+                        self.roots[root] = True
+                return root
+        return None
+
+    def load(self, root):
+        # 并行列出root下的整个目录树，列目录的往返彼此重叠
+        with ThreadPoolExecutor(max_workers=REMOTE_LIST_WORKERS) as executor:
+            pending = {executor.submit(list_directory, root)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    listing = future.result()
+                    if listing is None:
+                        continue  # 目录不存在，或者列的过程中被删掉了
+                    files, dirs = listing
+                    self.files.update(files)
+                    self.dirs.update(dirs)
+                    pending.update(executor.submit(list_directory, path) for path in dirs)
+
+    def exists(self, path):
+        if self.covering_root(path) is None:
+            return os.path.exists(path)
+        return path in self.files or path in self.dirs
+
+    def makedirs(self, path):
+        # 先确保所在的目标目录已经列过，免得列目录时和这里的修改交错
+        self.covering_root(path)
+        if path in self.dirs:
+            return
+        os.makedirs(path, exist_ok=True)
+        while path not in self.dirs and os.path.dirname(path) != path:
+            self.dirs.add(path)
+            path = os.path.dirname(path)
+
+    def add_file(self, path):
+        self.files.add(path)
+
+    def discard(self, path):
+        self.files.discard(path)
+        self.dirs.discard(path)
+
+
+class ParallelCopier:
+    # 用线程池并行拷贝一批文件，按完成顺序产出结果，供备份线程更新进度、清单和检查取消
+
+    def __init__(self, workers, recycle_bin, backup_root, is_canceled, backend, progress=None, measure=null_measure,
+                 dest_index=None):
+        self.workers = max(1, workers)
+        self.recycle_bin = recycle_bin
+        self.backup_root = backup_root
+        self.is_canceled = is_canceled
+        self.backend = backend
+        self.progress = progress
+        self.measure = measure  # 性能统计：measure(阶段, path=..., size=...) 返回计时的上下文管理器
+        # 网络目标模式的目标目录索引：目标文件是否存在从内存回答，目录由拷贝线程在用到时创建，与拷贝重叠进行
+        self.dest_index = dest_index
+
+    def copy_one(self, file_path, dest_path, hash_files, block_cache=None, rel_path=None):
+        # 在工作线程中执行：先拷贝到临时文件，完成后把旧文件移入回收站再改名，需要时返回拷贝内容的摘要
+        # 给出block_cache（增量拷贝模式）时，已有备份的大文件改为原位只改写变化的块
+        if self.is_canceled():
+            raise BackupCanceled()
+        if block_cache is not None:
+            hasher = new_content_hasher() if hash_files else None
+            if self.delta_copy(file_path, dest_path, hasher, block_cache, rel_path):
+                return hasher.hexdigest() if hasher is not None else None
+        hasher = new_content_hasher() if hash_files else None
+        temp_path = dest_path + TEMP_FILE_SUFFIX
+        if self.dest_index is not None:
+            self.dest_index.makedirs(os.path.dirname(dest_path))
+        with self.measure('copy', path=file_path, size=None):
+            self.backend.copy(file_path, temp_path, self.is_canceled, hasher, self.progress)
+        if self.dest_index.exists(dest_path) if self.dest_index is not None else os.path.exists(dest_path):
+            with self.measure('recycle'):
+                move_into_recycle_bin(dest_path, self.recycle_bin, self.backup_root, self.dest_index)
+        os.replace(temp_path, dest_path)
+        if self.dest_index is not None:
+            self.dest_index.add_file(dest_path)
+        return hasher.hexdigest() if hasher is not None else None
+
+    def delta_copy(self, file_path, dest_path, hasher, block_cache, rel_path):
+        # 返回是否完成了增量拷贝；文件太小、还没有备份或增量拷贝出错时返回False，由调用方改用完整拷贝
+        # 原位改写不是原子的，开始前先删掉缓存中的块摘要：中途取消或出错时清单中这个文件仍是有变化的，
+        # 下次会读取目标文件重新比较，不会使用过期的摘要；出错时完整拷贝会用临时文件原子地替换掉写了一半的目标
+        if self.dest_index is not None and not self.dest_index.exists(dest_path):
+            return False  # 还没有备份，不需要去目标上查询
+        try:
+            dest_st = os.stat(dest_path)
+            if not stat.S_ISREG(dest_st.st_mode) or os.stat(file_path).st_size < DELTA_COPY_MIN_SIZE:
+                return False
+        except OSError:
+            return False
+        old_digests = block_cache.pop(rel_path, dest_st)
+        start = time.perf_counter()
+        try:
+            with self.measure('delta', path=file_path, size=dest_st.st_size):
+                written, digests = delta_copy(file_path, dest_path, old_digests, self.is_canceled, hasher,
+                                              self.progress)
+        except OSError as e:
+            if e.errno in (errno.ENOSPC, errno.EDQUOT):
+                raise
+            return False
+        dest_st = os.stat(dest_path)
+        block_cache.put(rel_path, dest_st, digests)
+        self.backend.record_delta(dest_st.st_size, written, time.perf_counter() - start)
+        return True
+
+    def copy_tree_files(self, source, destination, rel_paths, hash_files=False, block_cache=None):
+        # 逐个产出已拷贝完成的 (相对路径, 内容摘要)；只有hash_files为True时才计算摘要；block_cache见copy_one
+        # 取消后正在拷贝的文件在下一个数据块处中止
+        # 目标目录统一在提交任务前创建，避免多个线程竞争创建同一目录；网络目标模式下由拷贝线程在用到时创建
+        if self.dest_index is None:
+            for target_dir in {os.path.dirname(os.path.join(destination, rel_path)) for rel_path in rel_paths}:
+                os.makedirs(target_dir, exist_ok=True)
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            futures = {executor.submit(self.copy_one, os.path.join(source, rel_path),
+                                       os.path.join(destination, rel_path), hash_files, block_cache, rel_path): rel_path
+                       for rel_path in rel_paths}
+            for future in as_completed(futures):
+                # 拷贝出错或取消时在备份线程中抛出，由调用方统一处理
+                yield futures[future], future.result()
+        finally:
+            # 取消或出错时丢弃尚未开始的任务，并等待正在拷贝的文件结束
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+class FileManifest:
+    # 备份目标的持久化文件清单，记录上次成功备份时源文件的状态
+    # 文件格式：{"version": 1, "source": 源路径, "files": {相对路径: [大小, 修改时间, inode]}}
+    # 快照模式下还有 "snapshot": 最近一次完整快照的目录名；压缩目标还有 "compression": 压缩包使用的压缩设置
+
+    VERSION = 1
+
+    def __init__(self, path, source, files=None):
+        self.path = path
+        self.source = source
+        self.files = files if files is not None else {}
+        self.snapshot = None
+        self.compression = None  # 压缩目标上次使用的 [压缩方式, 是否直接存储不可压缩的文件]
+        self.loaded = False  # 是否从磁盘读到了有效的清单
+
+    @classmethod
+    def load(cls, path, source):
+        manifest = cls(path, source)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return manifest
+        # 版本或源路径对不上的清单视为不存在，退回到逐文件比较
+        if data.get('version') == cls.VERSION and data.get('source') == source:
+            manifest.files = data.get('files', {})
+            manifest.snapshot = data.get('snapshot')
+            manifest.compression = data.get('compression')
+            manifest.loaded = True
+        return manifest
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = self.path + '.tmp'
+        data = {'version': self.VERSION, 'source': self.source, 'files': self.files}
+        if self.snapshot is not None:
+            data['snapshot'] = self.snapshot
+        if self.compression is not None:
+            data['compression'] = self.compression
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(temp_path, self.path)  # 先写临时文件再替换，避免中断时留下损坏的清单
+        self.loaded = True
+
+    def is_changed(self, rel_path, entry):
+        # 大小或修改时间与清单不一致即认为有变化，inode留作识别改名等用途
+        old = self.files.get(rel_path)
+        return old is None or old[0] != entry[0] or old[1] != entry[1]
+
+
+class HashCache:
+    # 内容校验模式下的文件摘要缓存，键为 inode:大小:修改时间，与路径无关
+    # 文件格式：{"version": 1, "digests": {键: 摘要}}
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.digests = {}
+
+    @classmethod
+    def load(cls, path):
+        cache = cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return cache
+        if data.get('version') == cls.VERSION:
+            cache.digests = data.get('digests', {})
+        return cache
+
+    @staticmethod
+    def key(entry):
+        return f"{entry[2]}:{entry[0]}:{entry[1]!r}"
+
+    def get(self, entry):
+        # 文件系统不提供inode时（值为0）无法区分文件，不使用缓存
+        if not entry[2]:
+            return None
+        return self.digests.get(self.key(entry))
+
+    def put(self, entry, digest):
+        if entry[2]:
+            self.digests[self.key(entry)] = digest
+
+    def save(self, keep_entries):
+        # 只保留清单中仍在使用的摘要，避免缓存无限增长
+        keep = {self.key(entry) for entry in keep_entries}
+        self.digests = {key: digest for key, digest in self.digests.items() if key in keep}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump({'version': self.VERSION, 'digests': self.digests}, file)
+        os.replace(temp_path, self.path)
+
+
+class BlockDigestCache:
+    # 增量拷贝的块摘要缓存：相对路径 -> 备份后目标文件的大小、修改时间和各数据块的摘要
+    # 目标文件的大小和修改时间与记录一致时直接使用缓存的摘要，不必每次都重读目标文件
+    # 文件格式：{"version": 1, "block_size": 块大小, "files": {相对路径: [大小, 修改时间, [摘要, ...]]}}
+    # 多个拷贝线程会同时读写，用锁保护
+
+    VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        cache = cls(path)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            return cache
+        if data.get('version') == cls.VERSION and data.get('block_size') == DELTA_BLOCK_SIZE:
+            cache.files = data.get('files', {})
+        return cache
+
+    def pop(self, rel_path, dest_st):
+        # 取出并删除目标文件的块摘要；目标文件在上次备份后被改动过时返回None
+        with self.lock:
+            record = self.files.pop(rel_path, None)
+        if record is None or record[0] != dest_st.st_size or record[1] != dest_st.st_mtime:
+            return None
+        return record[2]
+
+    def put(self, rel_path, dest_st, digests):
+        with self.lock:
+            self.files[rel_path] = [dest_st.st_size, dest_st.st_mtime, digests]
+
+    def save(self, keep_paths):
+        # 只保留清单中仍在使用的文件
+        with self.lock:
+            self.files = {rel_path: record for rel_path, record in self.files.items() if rel_path in keep_paths}
+            data = {'version': self.VERSION, 'block_size': DELTA_BLOCK_SIZE, 'files': self.files}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            json.dump(data, file)
+        os.replace(temp_path, self.path)
+
+
+class ChunkStore:
+    # 内容寻址的去重块存储：每个不同内容的数据块只保存一次，数据块压缩后追加写入 packs/ 下的包文件
+    # 每个包文件旁有同名的 .idx 块索引，每行一个 [块摘要, 偏移, 长度, 是否压缩]，只追加新写入的块，
+    # 保存索引的开销与新数据量成正比，与整个存储的大小无关；打开时读入所有 .idx
+    # 包文件先刷新到磁盘再追加索引，中途崩溃时最多留下未被索引的块或写了一半的最后一行，不会出现索引指向不存在的数据
+    # 旧版本的整体索引 chunks.json 仍然读取，不再改写
+
+    VERSION = 1
+
+    def __init__(self, root):
+        self.root = root
+        self.chunks = {}  # 块摘要 -> [包文件名, 偏移, 长度, 是否压缩]
+        self.pack_name = None
+        self.pack_file = None
+        self.unsaved = []  # 当前包文件中还没有写入 .idx 的块
+        self.lock = threading.RLock()  # 多个去重备份项可能同时写入
+
+    @classmethod
+    def open(cls, root):
+        store = cls(root)
+        packs_dir = os.path.join(root, 'packs')
+        os.makedirs(packs_dir, exist_ok=True)
+        try:
+            with open(os.path.join(root, 'chunks.json'), 'r', encoding='utf-8') as file:
+                data = json.load(file)
+            if data.get('version') == cls.VERSION:
+                store.chunks = data.get('chunks', {})
+        except (OSError, ValueError):
+            pass
+        for name in os.listdir(packs_dir):
+            if name.endswith('.idx'):
+                store.load_pack_index(os.path.join(packs_dir, name), name[:-len('.idx')] + '.pack')
+        return store
+
+    def load_pack_index(self, index_path, pack_name):
+        with open(index_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                try:
+                    chunk_id, offset, length, is_compressed = json.loads(line)
+                except (ValueError, TypeError):
+                    break  # 崩溃时写了一半的最后一行
+                self.chunks[chunk_id] = [pack_name, offset, length, is_compressed]
+
+    @staticmethod
+    def chunk_id(data):
+        return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+    def put(self, data):
+        # 返回 (块摘要, 写入包文件的字节数)；块已经存在时不写入，字节数为0
+        chunk_id = self.chunk_id(data)
+        if chunk_id in self.chunks:
+            return chunk_id, 0
+        compressed = zlib.compress(data, CHUNK_COMPRESS_LEVEL)
+        is_compressed = len(compressed) < len(data)
+        if not is_compressed:
+            compressed = data
+        with self.lock:
+            if chunk_id in self.chunks:
+                return chunk_id, 0
+            if self.pack_file is None or self.pack_file.tell() >= PACK_FILE_MAX_SIZE:
+                self.new_pack()
+            offset = self.pack_file.tell()
+            self.pack_file.write(compressed)
+            self.chunks[chunk_id] = [self.pack_name, offset, len(compressed), is_compressed]
+            self.unsaved.append(chunk_id)
+        return chunk_id, len(compressed)
+
+    def new_pack(self):
+        if self.pack_file is not None:
+            self.save()
+            self.pack_file.close()
+        self.pack_name = datetime.now().strftime("%Y%m%d_%H%M%S_%f") + '.pack'
+        self.pack_file = open(os.path.join(self.root, 'packs', self.pack_name), 'ab')
+
+    def flush_pack(self):
+        self.pack_file.flush()
+        os.fsync(self.pack_file.fileno())
+
+    def read(self, chunk_id):
+        pack_name, offset, length, is_compressed = self.chunks[chunk_id]
+        with self.lock:
+            if pack_name == self.pack_name:
+                self.pack_file.flush()
+        with open(os.path.join(self.root, 'packs', pack_name), 'rb') as file:
+            file.seek(offset)
+            data = file.read(length)
+        return zlib.decompress(data) if is_compressed else data
+
+    def save(self):
+        # 把当前包文件中新写入的块追加到它的 .idx
+        with self.lock:
+            if self.pack_file is None or not self.unsaved:
+                return
+            self.flush_pack()
+            index_path = os.path.join(self.root, 'packs', self.pack_name[:-len('.pack')] + '.idx')
+            with open(index_path, 'a', encoding='utf-8') as file:
+                file.write(''.join(json.dumps([chunk_id] + self.chunks[chunk_id][1:]) + '\n'
+                                   for chunk_id in self.unsaved))
+                file.flush()
+                os.fsync(file.fileno())
+            self.unsaved = []
+
+    def close(self):
+        with self.lock:
+            self.save()
+            if self.pack_file is not None:
+                self.pack_file.close()
+                self.pack_file = None
+
+
+def load_chunk_index(index_path):
+    # 读取去重目标某次备份的文件索引：相对路径 -> [大小, 修改时间, inode, [块摘要, ...]]；读取失败时返回None
+    try:
+        with open(index_path, 'r', encoding='utf-8') as file:
+            return json.load(file)['files']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def restore_from_chunk_store(index_path, destination, is_canceled=lambda: False):
+    # 按某次备份的文件索引把文件从块存储还原到destination下，返回还原的文件数
+    # 索引位于 块存储/目标名_索引/ 下，块存储就是它的上两级目录
+    files = load_chunk_index(index_path)
+    if files is None:
+        raise ValueError(f"无法读取索引文件 {index_path}")
+    store = ChunkStore.open(os.path.dirname(os.path.dirname(os.path.abspath(index_path))))
+    for rel_path, (size, mtime, _, chunk_ids) in files.items():
+        file_path = os.path.join(destination, rel_path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path + TEMP_FILE_SUFFIX, 'wb') as file:
+            for chunk_id in chunk_ids:
+                if is_canceled():
+                    raise BackupCanceled()
+                file.write(store.read(chunk_id))
+        os.utime(file_path + TEMP_FILE_SUFFIX, (mtime, mtime))
+        os.replace(file_path + TEMP_FILE_SUFFIX, file_path)
+    return len(files)
+
+
+class RunJournal:
+    # 备份进度日志：每完成一个文件追加一行并立即刷新，程序崩溃、被关闭或取消后，下次备份从中断处继续
+    # 第一行为 {"source": 源路径, "snapshot": 未完成的快照目录名或null}，之后每行为 [相对路径, 大小, 修改时间, inode]
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+
+    @staticmethod
+    def read(path, source):
+        # 返回 (未完成的快照目录名, {相对路径: 条目})；没有日志或源路径不匹配时返回 (None, {})
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                lines = file.read().splitlines()
+        except OSError:
+            return None, {}
+        try:
+            header = json.loads(lines[0])
+        except (IndexError, ValueError):
+            return None, {}
+        if header.get('source') != source:
+            return None, {}
+        done = {}
+        for line in lines[1:]:
+            try:
+                rel_path, *entry = json.loads(line)
+            except ValueError:
+                break  # 崩溃时写了一半的最后一行
+            done[rel_path] = entry
+        return header.get('snapshot'), done
+
+    def start(self, source, snapshot=None, done=None):
+        # 开始记录，done中是继续上次中断的备份时已经完成的文件
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path, 'w', encoding='utf-8')
+        self.file.write(json.dumps({'source': source, 'snapshot': snapshot}, ensure_ascii=False) + '\n')
+        for rel_path, entry in (done or {}).items():
+            self.file.write(json.dumps([rel_path] + list(entry), ensure_ascii=False) + '\n')
+        self.file.flush()
+
+    def record(self, rel_path, entry):
+        self.file.write(json.dumps([rel_path] + list(entry), ensure_ascii=False) + '\n')
+        self.file.flush()  # 刷新到操作系统即可应对程序崩溃，每个文件都fsync代价太大
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def discard(self):
+        # 清单保存成功后日志就没用了
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ProgressTracker:
+    # 按字节统计备份进度：拷贝和压缩循环每处理完一个数据块就累加，可在多个线程中调用
+    # 计划字节数只包含确实需要拷贝或压缩的文件，确定每个备份项的实际工作量后再修正；
+    # 进度事件按PROGRESS_REPORT_INTERVAL限制频率，不会每个数据块都发给界面
+
+    def __init__(self, report, interval=PROGRESS_REPORT_INTERVAL):
+        self.report = report
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.done = 0
+        self.planned = 0
+        self.last_report = 0.0
+
+    def plan(self, size):
+        # 增加（size为负时减少）计划字节数
+        with self.lock:
+            self.planned += size
+        self.flush()
+
+    def advance(self, size):
+        with self.lock:
+            self.done += size
+            now = time.monotonic()
+            if now - self.last_report < self.interval:
+                return
+            self.last_report = now
+            done, planned = self.done, self.planned
+        self.report(done, planned)
+
+    def flush(self):
+        with self.lock:
+            self.last_report = time.monotonic()
+            done, planned = self.done, self.planned
+        self.report(done, planned)
+
+
+class ThroughputEstimator:
+    # 由进度估算剩余时间：速度按时间常数做指数平滑，不会因为一个大文件或一批小文件而大幅跳动
+
+    def __init__(self, smoothing_seconds=THROUGHPUT_SMOOTHING_SECONDS):
+        self.smoothing_seconds = smoothing_seconds
+        self.rate = None  # 平滑后的速度，字节/秒
+        self.last_time = None
+        self.last_done = 0
+
+    def update(self, done, now=None):
+        now = time.monotonic() if now is None else now
+        if self.last_time is None:
+            self.last_time, self.last_done = now, done
+            return
+        elapsed = now - self.last_time
+        if elapsed <= 0:
+            return
+        sample = max(done - self.last_done, 0) / elapsed
+        weight = 1 - math.exp(-elapsed / self.smoothing_seconds)
+        self.rate = sample if self.rate is None else self.rate + weight * (sample - self.rate)
+        self.last_time, self.last_done = now, done
+
+    def remaining_seconds(self, done, planned):
+        # 还没有速度数据时返回None
+        if not self.rate:
+            return None
+        return max(planned - done, 0) / self.rate
+
+
+class RunMetrics:
+    # 一次备份的分阶段性能统计：每个备份目标在扫描、摘要、拷贝、压缩、移入回收站、保存清单等阶段的累计用时、
+    # 文件数和字节数，以及用时最长的几个文件。拷贝和摘要在多个线程中进行，各线程的用时相加，可能超过实际经过的时间
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.targets = {}  # 备份目标 -> 阶段 -> [秒, 文件数, 字节数]
+        self.slowest = []  # 用时最长的文件，最小堆 (秒, 备份目标, 阶段, 路径)
+
+    def add(self, target, phase, seconds, files=1, size=0, path=None):
+        with self.lock:
+            total = self.targets.setdefault(target, {}).setdefault(phase, [0.0, 0, 0])
+            total[0] += seconds
+            total[1] += files
+            total[2] += size
+            if path is not None:
+                record = (seconds, target, phase, path)
+                if len(self.slowest) < METRICS_SLOWEST_COUNT:
+                    heapq.heappush(self.slowest, record)
+                elif record > self.slowest[0]:
+                    heapq.heapreplace(self.slowest, record)
+
+    @contextlib.contextmanager
+    def measure(self, target, phase, files=1, size=0, path=None):
+        # 计时一段操作；size为None时结束后取path的文件大小
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            if size is None:
+                try:
+                    size = os.stat(path).st_size
+                except OSError:
+                    size = 0
+            self.add(target, phase, seconds, files, size, path)
+
+    def summary(self, copy_backend=None):
+        with self.lock:
+            result = {
+                'targets': {target: {phase: {'seconds': round(seconds, 4), 'files': files, 'bytes': size}
+                                     for phase, (seconds, files, size) in phases.items()}
+                            for target, phases in self.targets.items()},
+                'slowest': [{'seconds': round(seconds, 4), 'target': target, 'phase': phase, 'path': path}
+                            for seconds, target, phase, path in sorted(self.slowest, reverse=True)],
+            }
+        if copy_backend is not None:
+            # 各拷贝方式（reflink、copy_file_range等系统调用）的文件数、字节数和耗时
+            with copy_backend.lock:
+                result['copy_methods'] = {strategy: {'files': files, 'bytes': size, 'seconds': round(seconds, 4)}
+                                          for strategy, (files, size, seconds) in copy_backend.stats.items()}
+        return result
+
+
+def format_log_record(level, message, **fields):
+    # 结构化日志的一行：时间、级别、消息和附加字段，界面的日志文件和命令行共用这个格式
+    record = {'time': datetime.now().isoformat(timespec='seconds'), 'level': level, 'message': message}
+    record.update(fields)
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+class RotatingLogFile:
+    # 追加写入的日志文件，超过max_bytes后改名为 .1（原来的 .1 改为 .2，依此类推），最多保留backups个旧文件
+
+    def __init__(self, path, max_bytes=LOG_FILE_MAX_BYTES, backups=LOG_FILE_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def write_lines(self, lines):
+        # 一批日志一次写入并刷新，之后再检查是否需要轮换
+        self.file.writelines(lines)
+        self.file.flush()
+        if self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{index}"):
+                os.replace(f"{self.path}.{index}", f"{self.path}.{index + 1}")
+        os.replace(self.path, f"{self.path}.1")
+        self.file = open(self.path, 'a', encoding='utf-8')
+
+    def close(self):
+        self.file.close()
+
+
+# 校验任务在子进程中执行，都是模块级函数；返回 [(相对路径, 原因), ...]，内容一致时返回空列表
+def read_file_range(file_path, offset, length, consume):
+    # 从offset起读取length字节（None表示到文件末尾），每块数据交给consume，返回实际读取的字节数
+    buffer = bytearray(VERIFY_READ_SIZE)
+    view = memoryview(buffer)
+    done = 0
+    with open(file_path, 'rb', buffering=0) as file:
+        file.seek(offset)
+        while length is None or done < length:
+            size = len(buffer) if length is None else min(len(buffer), length - done)
+            count = file.readinto(view[:size])
+            if not count:
+                break
+            consume(view[:count])
+            done += count
+    return done
+
+
+def verify_file_range(rel_path, source, backup, offset, length):
+    # 比较源文件和备份文件同一段内容的摘要
+    digests = []
+    try:
+        for file_path in (source, backup):
+            hasher = new_content_hasher()
+            if read_file_range(file_path, offset, length, hasher.update) != length:
+                return [(rel_path, "文件在校验期间被截断")]
+            digests.append(hasher.digest())
+    except OSError as e:
+        return [(rel_path, f"读取出错: {e}")]
+    if digests[0] != digests[1]:
+        return [(rel_path, f"内容不一致（偏移 {offset}）")]
+    return []
+
+
+def verify_zip_entries(zip_path, entries):
+    # entries为 [(相对路径, 源文件, 条目名), ...]：源文件的CRC与条目记录的CRC比较，
+    # 再完整读出条目数据，读到末尾时zipfile会检查解压出的数据与记录的CRC是否一致
+    mismatches = []
+    try:
+        zipf = zipfile.ZipFile(zip_path)
+    except (OSError, zipfile.BadZipFile) as e:
+        return [(rel_path, f"无法打开压缩包: {e}") for rel_path, _, _ in entries]
+    with zipf:
+        for rel_path, source, arcname in entries:
+            try:
+                info = zipf.getinfo(arcname)
+                crc = 0
+
+                def update(data):
+                    nonlocal crc
+                    crc = zlib.crc32(data, crc)
+
+                read_file_range(source, 0, None, update)
+                if crc != info.CRC:
+                    mismatches.append((rel_path, "压缩包中的CRC与源文件不一致"))
+                    continue
+                with zipf.open(info) as member:
+                    while member.read(VERIFY_READ_SIZE):
+                        pass
+            except KeyError:
+                mismatches.append((rel_path, "压缩包中缺少此文件"))
+            except (OSError, zipfile.BadZipFile, zlib.error) as e:
+                mismatches.append((rel_path, f"压缩包数据损坏: {e}"))
+    return mismatches
+
+
+def verify_batch(function, batch):
+    # 在一个校验进程中依次校验一批小文件，batch为function的参数列表
+    return [mismatch for args in batch for mismatch in function(*args)]
+
+
+def verify_chunk_file(rel_path, source, store_root, locations):
+    # locations为文件各数据块的 (块摘要, 包文件名, 偏移, 长度, 是否压缩)：逐块读出并检查块摘要，
+    # 再与源文件内容的摘要比较
+    stored = new_content_hasher()
+    try:
+        for chunk_id, pack_name, offset, length, is_compressed in locations:
+            with open(os.path.join(store_root, 'packs', pack_name), 'rb') as file:
+                file.seek(offset)
+                data = file.read(length)
+            if is_compressed:
+                data = zlib.decompress(data)
+            if ChunkStore.chunk_id(data) != chunk_id:
+                return [(rel_path, f"数据块 {chunk_id} 已损坏")]
+            stored.update(data)
+        hasher = new_content_hasher()
+        read_file_range(source, 0, None, hasher.update)
+    except (OSError, zlib.error) as e:
+        return [(rel_path, f"读取出错: {e}")]
+    if stored.digest() != hasher.digest():
+        return [(rel_path, "块存储中的内容与源文件不一致")]
+    return []
+
+
+def path_device(path):
+    # 路径所在设备的编号，路径还不存在时取最近的已存在的上级目录；都不存在时返回None
+    while True:
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return None
+            path = parent
+
+
+class DeviceScheduler:
+    # 多个备份项同时进行：同一块磁盘（源或目标所在的设备）上同时进行的备份项不超过device_limit个，
+    # 不同磁盘上的备份项互不等待；按大小从大到小开始，大的备份项不会拖到最后单独运行
+
+    def __init__(self, workers, device_limit, is_canceled):
+        self.workers = max(1, workers)
+        self.device_limit = max(1, device_limit)
+        self.is_canceled = is_canceled
+        self.condition = threading.Condition()
+        self.busy = {}  # 设备 -> 正在进行的备份项数
+        self.running = 0
+
+    def run(self, jobs, function):
+        # jobs为 [(设备集合, 大小, 参数), ...]，对每个参数在线程池中调用function，全部完成或取消后返回
+        pending = sorted(jobs, key=lambda job: -job[1])
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            with self.condition:
+                while pending and not self.is_canceled():
+                    job = None
+                    if self.running < self.workers:
+                        job = next((job for job in pending
+                                    if all(self.busy.get(device, 0) < self.device_limit for device in job[0])), None)
+                    if job is None:
+                        self.condition.wait(0.5)
+                        continue
+                    pending.remove(job)
+                    self.running += 1
+                    for device in job[0]:
+                        self.busy[device] = self.busy.get(device, 0) + 1
+                    future = executor.submit(function, job[2])
+                    future.add_done_callback(functools.partial(self.finish, job[0]))
+                    futures.append(future)
+        for future in futures:
+            future.result()  # 把备份项中未处理的异常抛给调用者
+
+    def finish(self, devices, future):
+        with self.condition:
+            self.running -= 1
+            for device in devices:
+                self.busy[device] -= 1
+            self.condition.notify()
+
+
+class BackupEngine:
+    # 备份引擎，在后台线程中运行，不直接操作界面，通过事件队列汇报进度、日志和错误
+
+    def __init__(self, backup_root, backup_items, copy_workers, events, compress_workers=DEFAULT_COMPRESS_WORKERS,
+                 dirty_paths=None, verify_workers=DEFAULT_VERIFY_WORKERS, item_workers=DEFAULT_ITEM_WORKERS,
+                 device_concurrency=DEFAULT_DEVICE_CONCURRENCY, collect_metrics=False, remote_destination=False,
+                 recycle_max_size=0, recycle_max_age=0):
+        self.backup_root = backup_root
+        self.backup_items = backup_items
+        self.copy_workers = copy_workers
+        self.compress_workers = compress_workers
+        self.verify_workers = verify_workers
+        self.item_workers = item_workers  # 同时进行的备份项数
+        self.device_concurrency = device_concurrency  # 每块磁盘上同时进行的备份项数
+        self.events = events
+        # 监视模式下为 {备份目标路径: 变化的相对路径集合或None}，只备份其中的目标，有路径集合时只重新检查这些路径
+        self.dirty_paths = dirty_paths
+        self.cancel_event = threading.Event()
+        self.progress = ProgressTracker(self.report_progress)  # 按字节统计的进度
+        self.active_items = []  # 正在备份的源路径，随进度事件发给界面
+        self.active_lock = threading.Lock()
+        self.chunk_store = None
+        self.chunk_store_lock = threading.Lock()
+        self.collect_metrics = collect_metrics  # 是否记录分阶段的性能统计，关闭时各阶段不计时
+        self.metrics = None
+        self.remote_destination = remote_destination  # 网络目标模式，见DestinationIndex
+        # 回收站保留策略：所有回收站的总大小上限（字节）和保留时间（秒），为0表示不限
+        self.recycle_max_size = recycle_max_size
+        self.recycle_max_age = recycle_max_age
+        self.dest_index = None
+
+    def cancel(self):
+        # 可以在任意线程中调用，拷贝和压缩会在下一个数据块处停止
+        self.cancel_event.set()
+
+    def is_canceled(self):
+        return self.cancel_event.is_set()
+
+    def log_message(self, message):
+        self.events.put(LogEvent(message))
+
+    def show_warning(self, title, message):
+        self.events.put(WarningEvent(title, message))
+
+    def report_progress(self, completed_size, total_size):
+        with self.active_lock:
+            active = tuple(self.active_items)
+        self.events.put(ProgressEvent(completed_size, total_size, active))
+
+    def run(self, verify=False):
+        # verify为True时不备份，只校验已有的备份
+        canceled = False
+        try:
+            canceled = self.run_verify() if verify else self.run_backup()
+        except Exception as e:
+            self.show_warning("未知错误", f"{'校验' if verify else '备份'}时发生未知错误: {e}")
+            self.log_message(f"未知错误: {e}")
+        finally:
+            self.events.put(FinishedEvent(canceled))
+
+    def run_backup(self):
+        # 执行一次完整的备份，返回是否被取消
+        start_time = time.time()
+
+        # 创建回收站
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        recycle_bin_path = os.path.join(self.backup_root, f"{RECYCLE_BIN_PREFIX}{timestamp}")
+        if not os.path.exists(recycle_bin_path):
+            os.makedirs(recycle_bin_path)
+
+        self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 开始备份进程。")
+        self.metrics = RunMetrics() if self.collect_metrics else None
+        self.dest_index = DestinationIndex() if self.remote_destination else None
+
+        # 一次扫描得到所有备份项的文件清单，按清单的差异估算需要拷贝或压缩的字节数
+        plans = self.scan_backup_items()
+        for plan in plans:
+            plan['planned'] = self.estimate_planned_size(plan)
+            self.progress.plan(plan['planned'])
+        self.check_recycle_bin_volume(plans, recycle_bin_path)
+
+        # 多个备份项同时进行，按源和目标所在的磁盘限制并发，大的备份项先开始
+        copy_backend = CopyBackend()
+        self.chunk_store = None  # 第一次用到时再打开
+        scheduler = DeviceScheduler(self.item_workers, self.device_concurrency, self.is_canceled)
+        scheduler.run([(self.plan_devices(plan), plan['planned'], plan) for plan in plans],
+                      functools.partial(self.backup_plan, recycle_bin_path=recycle_bin_path, copy_backend=copy_backend))
+
+        end_time = time.time() 
+        elapsed_time = end_time - start_time 
+        hours, remainder = divmod(int(elapsed_time), 3600)
+        minutes, seconds = divmod(remainder, 60)
+        elapsed_time_str = f"{hours}小时{minutes}分钟{seconds}秒 ({elapsed_time:.2f}秒)"
+        self.log_message(f"用时：{elapsed_time_str}")
+        if self.chunk_store is not None:
+            self.chunk_store.close()
+        for line in copy_backend.summary():
+            self.log_message(line)
+        if self.metrics is not None:
+            self.save_metrics(copy_backend, timestamp)
+
+        # 检查回收站是否为空，如果是，则删除
+        if os.path.exists(recycle_bin_path) and not os.listdir(recycle_bin_path):
+            shutil.rmtree(recycle_bin_path)  # 删除空的回收站目录
+            self.log_message(f"回收站 {recycle_bin_path} 是空的，已经被删除。")
+        else:
+            self.log_message(f"回收站 {recycle_bin_path} 不是空的，未被删除。")
+        self.enforce_recycle_retention(recycle_bin_path)
+
+
+        if self.is_canceled():
+            self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 备份已取消。")
+            return True
+        self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 备份已完成。")
+        return False
+
+    def check_recycle_bin_volume(self, plans, recycle_bin_path):
+        # 目标在另外挂载的卷上时，移入回收站不能只改名，需要拷贝后删除，提示一次
+        bin_device = path_device(recycle_bin_path)
+        for plan in plans:
+            device = path_device(plan['destination'])
+            if device is not None and bin_device is not None and device != bin_device:
+                self.log_message(f"{plan['destination']} 与回收站不在同一个卷上，替换下的旧文件移入回收站时需要拷贝")
+
+    def enforce_recycle_retention(self, recycle_bin_path):
+        # 更新回收站索引，按保留策略删除最旧的回收站；出错时只记录日志，不影响备份结果
+        index_path = os.path.join(self.backup_root, MANIFEST_DIR_NAME, RECYCLE_INDEX_FILE_NAME)
+        try:
+            index = RecycleBinIndex.load(index_path)
+            if os.path.isdir(recycle_bin_path):
+                index.add(recycle_bin_path)
+            index.sync(self.backup_root)
+            for name in index.expired(self.recycle_max_size, self.recycle_max_age,
+                                      os.path.basename(recycle_bin_path), time.time()):
+                try:
+                    shutil.rmtree(os.path.join(self.backup_root, name))
+                except OSError as e:
+                    self.log_message(f"删除旧回收站 {name} 出错: {e}")
+                    continue
+                info = index.bins.pop(name)
+                self.log_message(f"按回收站保留策略删除了 {name}（{self.size_to_string(info['size'], info['size'])}）")
+            index.save()
+        except OSError as e:
+            self.log_message(f"更新回收站索引出错: {e}")
+            return
+        total = index.total_size()
+        self.log_message(f"现有 {len(index.bins)} 个回收站，共 {self.size_to_string(total, total)}")
+
+    def backup_plan(self, plan, recycle_bin_path, copy_backend):
+        # 备份一个备份项，在调度器的线程中执行，多个备份项可能同时进行
+        item = plan['item']
+        source = item['path']
+        try:
+            if self.is_canceled():
+                raise BackupCanceled()
+            with self.active_lock:
+                self.active_items.append(source)
+            # 每个备份项用自己的拷贝器，拷贝的字节数计入这个备份项
+            copier = ParallelCopier(self.copy_workers, recycle_bin_path, self.backup_root, self.is_canceled,
+                                    copy_backend, functools.partial(self.advance_plan, plan),
+                                    functools.partial(self.measure, source), self.dest_index)
+
+            destination = plan['destination']
+            is_dir = item['is_dir']
+            should_zip = item['zip']
+            entries = plan['entries']
+            manifest = plan['manifest']
+
+            # 检查源是否存在
+            if entries is None:
+                self.show_warning('警告', f'源路径 {source} 不存在。')
+                return
+            if plan['resumed']:
+                self.log_message(f"继续上次中断的备份，已完成 {len(plan['resumed'])} 个文件：{source}")
+
+            # 镜像模式：先按清单的差异处理源中删除和改名的文件，改名的文件不再重新拷贝
+            dedup = item.get('dedup', False) and not should_zip
+            snapshot = item.get('snapshot', False) and not should_zip and not dedup
+            if self.dest_index is not None and is_dir and not should_zip and not snapshot and not dedup:
+                # 直接拷贝的目标目录在第一次需要查询时整体列出
+                self.dest_index.register(destination)
+            if item.get('mirror') and is_dir and not should_zip and not snapshot and not dedup and manifest.loaded:
+                self.mirror_deletions(plan, recycle_bin_path)
+
+            # 检查是否需要更新，得到需要拷贝的文件列表；快照模式和去重块存储单独判断
+            changed = self.plan_changes(plan) if not snapshot and not dedup else None
+            if changed is not None and not (is_dir and should_zip):
+                # 拷贝的文件已经确定，修正估算的计划字节数
+                self.replan(plan, sum(entries[rel_path][0] for rel_path in changed))
+            if changed is not None and not changed:
+                self.log_message(f"未更新不备份：{source}")
+                if not manifest.loaded or plan['touched']:
+                    # 旧版本没有清单，或有文件只被touch过，记下当前状态，下次即可只比较清单
+                    manifest.files = entries
+                    self.save_manifest(plan)
+                return
+
+            # 去重块存储：只保存块存储中还没有的数据块，生成新的文件索引
+            if dedup:
+                if not self.backup_chunk_store(plan, self.open_chunk_store()):
+                    self.log_message(f"未更新不备份：{source}")
+                    return
+
+            # 快照模式：生成新的完整快照，未变化的文件硬链接到上一个快照
+            elif snapshot:
+                if not self.backup_snapshot(plan, copier):
+                    self.log_message(f"未更新不备份：{source}")
+                    return
+
+            # 如果是目录：
+            elif is_dir:
+                # 决定是否压缩
+                if should_zip:
+                    if self.zip_directory(source, destination, entries, recycle_bin_path, manifest,
+                                          plan['hash_cache'], functools.partial(self.advance_plan, plan),
+                                          CompressionPolicy.for_item(item)):
+                        manifest.files = entries
+                        self.save_manifest(plan)
+                        
+                else:
+                    # 只拷贝清单中有变化的文件，由线程池并行拷贝，每完成一个记入进度日志
+                    # 上次中断前已完成的文件也写入新的日志，再次中断时不会丢失
+                    plan['journal'].start(source, None, plan['resumed'])
+                    try:
+                        for rel_path, digest in copier.copy_tree_files(source, destination, changed,
+                                                                       plan['hash_cache'] is not None,
+                                                                       plan['block_cache']):
+                            manifest.files[rel_path] = entries[rel_path]
+                            plan['journal'].record(rel_path, entries[rel_path])
+                            if digest is not None:
+                                plan['hash_cache'].put(entries[rel_path], digest)
+                            self.log_message(f"备份文件：{os.path.join(source, rel_path)} 至 {os.path.join(destination, rel_path)}")
+                        manifest.files = entries
+                    finally:
+                        # 中途出错或取消时也保存已完成的部分，下次只需补拷剩下的文件
+                        self.save_manifest(plan)
+
+            # 如果是单个文件，直接备份
+            else:
+                digest = copier.copy_one(source, destination, plan['hash_cache'] is not None,
+                                         plan['block_cache'], os.path.basename(source))
+                if digest is not None:
+                    plan['hash_cache'].put(next(iter(entries.values())), digest)
+                manifest.files = entries
+                self.save_manifest(plan)
+
+            # 在拷贝每个文件后更新进度和日志
+            if is_dir and should_zip:
+                self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 压缩并备份：{source}")
+            else:
+                self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 备份：{source}")
+            self.replan(plan, plan['done'])
+            done, planned = self.progress.done, self.progress.planned
+            percent = round(100.0 * done / planned, 2) if planned else 100.0
+            self.log_message(f"已完成 {percent}% 的备份， {self.size_to_string(done, planned)}")
+
+        except BackupCanceled:
+            return  # 由run_backup统一记录取消
+
+        except PermissionError as pe:
+            self.show_warning("权限错误", f"无法访问 {source}。请检查文件的读写权限。")
+            self.log_message(f"权限错误: {pe}")
+            return  # Skip current file and continue with the next
+
+        except OSError as ose:
+            self.show_warning("操作系统错误", f"处理文件 {source} 时发生错误。")
+            self.log_message(f"操作系统错误: {ose}")
+            return  # Skip current file and continue with the next
+          
+        except Exception as e:
+            self.show_warning("未知错误", f"备份 {source} 时发生未知错误。")
+            self.log_message(f"未知错误: {e}")
+            return  # Skip current file and continue with the next
+
+        finally:
+            # 未更新、出错或取消的备份项按实际处理的字节数计入，不再占用计划字节数
+            self.replan(plan, plan['done'])
+            with self.active_lock:
+                if source in self.active_items:
+                    self.active_items.remove(source)
+
+    def run_verify(self):
+        # 校验已有的备份：直接拷贝和快照的文件与源文件比较内容摘要，压缩包条目比较CRC并检查压缩数据，
+        # 去重存储检查每个数据块并与源文件比较。摘要计算分布到多个进程，大文件分段并行，
+        # 总用时取决于磁盘带宽而不是单核的摘要速度。备份后源文件又被修改的文件无法比较，跳过
+        start_time = time.time()
+        self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 开始校验备份。")
+        tasks = []  # (校验函数, 参数, 源文件字节数, 源目录)
+        mismatches = []  # (源目录, 相对路径, 原因)
+        skipped = 0
+        try:
+            for item in self.backup_items:
+                if self.is_canceled():
+                    raise BackupCanceled()
+                item_tasks, item_mismatches, item_skipped = self.plan_verify(item)
+                tasks.extend(item_tasks)
+                source_dir = item['path'] if item['is_dir'] else os.path.dirname(item['path'])
+                mismatches.extend((source_dir, rel_path, reason) for rel_path, reason in item_mismatches)
+                skipped += item_skipped
+        except BackupCanceled:
+            self.log_message("校验已取消。")
+            return True
+        self.progress.plan(sum(task[2] for task in tasks))
+
+        pool = ProcessPoolExecutor(max(1, self.verify_workers))
+        try:
+            futures = {pool.submit(function, *args): (size, source) for function, args, size, source in tasks}
+            for future in as_completed(futures):
+                if self.is_canceled():
+                    raise BackupCanceled()
+                size, source = futures[future]
+                mismatches.extend((source, rel_path, reason) for rel_path, reason in future.result())
+                self.progress.advance(size)
+        except BackupCanceled:
+            self.log_message("校验已取消。")
+            return True
+        finally:
+            pool.shutdown(wait=True, cancel_futures=True)
+            self.progress.flush()
+
+        # 大文件的多个分段可能都不一致，同一个文件只报告一次
+        mismatches = list({(source, rel_path): (source, rel_path, reason)
+                           for source, rel_path, reason in mismatches}.values())
+        report_path = os.path.join(self.backup_root,
+                                   VERIFY_REPORT_PREFIX + datetime.now().strftime("%Y%m%d_%H%M%S") + '.json')
+        with open(report_path, 'w', encoding='utf-8') as file:
+            json.dump({'time': datetime.now().isoformat(timespec='seconds'), 'skipped': skipped,
+                       'mismatches': [{'path': os.path.join(source, rel_path), 'reason': reason}
+                                      for source, rel_path, reason in mismatches]},
+                      file, ensure_ascii=False, indent=1)
+        for source, rel_path, reason in mismatches:
+            self.log_message(f"校验不一致：{os.path.join(source, rel_path)}：{reason}")
+        elapsed_time_str = time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))
+        self.log_message(f"校验了 {self.progress.planned / 1024 ** 3:.2f}GB，{len(mismatches)} 个文件不一致，"
+                         f"{skipped} 个文件在备份后已修改未校验，用时：{elapsed_time_str}，报告：{report_path}")
+        if mismatches:
+            self.show_warning("校验", f"{len(mismatches)} 个文件与源文件不一致，详见 {report_path}")
+        return False
+
+    def plan_verify(self, item):
+        # 为一个备份项生成校验任务，返回 (任务列表, 不需要读取内容就能确定的不一致, 跳过的文件数)
+        # 以上次备份的清单为准：当前状态与清单不同的源文件在备份后被修改过，无法比较
+        source = item['path']
+        destination = self.get_item_destination(item)
+        manifest = FileManifest.load(self.get_manifest_path(destination), source)
+        tasks = []
+        mismatches = []
+        skipped = 0
+        if not manifest.loaded:
+            self.log_message(f"没有备份记录，不校验：{source}")
+            return tasks, mismatches, skipped
+        source_dir = source if item['is_dir'] else os.path.dirname(source)
+        current = scan_tree(source, PathRules.for_item(item), is_canceled=self.is_canceled) or {}
+        files = {rel_path: entry for rel_path, entry in manifest.files.items()
+                 if current.get(rel_path) is not None and not manifest.is_changed(rel_path, current[rel_path])}
+        skipped = len(manifest.files) - len(files)
+
+        if item['is_dir'] and item['zip']:
+            batch = []
+            batch_size = 0
+            for rel_path, entry in files.items():
+                batch.append((rel_path, os.path.join(source_dir, rel_path), rel_path.replace(os.sep, '/')))
+                batch_size += entry[0]
+                if batch_size >= VERIFY_BATCH_SIZE or len(batch) >= VERIFY_BATCH_FILES:
+                    tasks.append((verify_zip_entries, (destination, batch), batch_size, source_dir))
+                    batch, batch_size = [], 0
+            if batch:
+                tasks.append((verify_zip_entries, (destination, batch), batch_size, source_dir))
+            return tasks, mismatches, skipped
+
+        # 小文件按大小和个数打包成批，一批在一个进程中校验；大文件单独成为任务或分段
+        batch = []
+        batch_size = 0
+
+        def add_small(function, args, size):
+            nonlocal batch_size
+            batch.append(args)
+            batch_size += size
+            if batch_size >= VERIFY_BATCH_SIZE or len(batch) >= VERIFY_BATCH_FILES:
+                flush_batch(function)
+
+        def flush_batch(function):
+            nonlocal batch, batch_size
+            if batch:
+                tasks.append((verify_batch, (function, batch), batch_size, source_dir))
+            batch, batch_size = [], 0
+
+        if item.get('dedup'):
+            store_root = os.path.dirname(destination)
+            store = ChunkStore.open(store_root)
+            index = load_chunk_index(os.path.join(destination, manifest.snapshot or '')) or {}
+            for rel_path, entry in files.items():
+                if rel_path not in index:
+                    mismatches.append((rel_path, "索引中缺少此文件"))
+                    continue
+                missing = [chunk_id for chunk_id in index[rel_path][3] if chunk_id not in store.chunks]
+                if missing:
+                    mismatches.append((rel_path, f"块存储中缺少 {len(missing)} 个数据块"))
+                    continue
+                locations = [(chunk_id, *store.chunks[chunk_id]) for chunk_id in index[rel_path][3]]
+                add_small(verify_chunk_file, (rel_path, os.path.join(source_dir, rel_path), store_root, locations),
+                          entry[0])
+            flush_batch(verify_chunk_file)
+            return tasks, mismatches, skipped
+
+        if item.get('snapshot'):
+            backup_dir = os.path.join(destination, manifest.snapshot or '')
+        else:
+            backup_dir = destination if item['is_dir'] else os.path.dirname(destination)
+        for rel_path, entry in files.items():
+            backup_path = os.path.join(backup_dir, rel_path)
+            try:
+                backup_size = os.stat(backup_path).st_size
+            except OSError:
+                mismatches.append((rel_path, "备份中缺少此文件"))
+                continue
+            if backup_size != entry[0]:
+                mismatches.append((rel_path, f"大小不一致：源文件 {entry[0]} 字节，备份 {backup_size} 字节"))
+                continue
+            if entry[0] <= VERIFY_RANGE_SIZE:
+                add_small(verify_file_range, (rel_path, os.path.join(source_dir, rel_path), backup_path, 0, entry[0]),
+                          entry[0])
+                continue
+            # 大文件分段，各段由不同进程同时读取和计算摘要
+            for offset in range(0, entry[0], VERIFY_RANGE_SIZE):
+                length = min(VERIFY_RANGE_SIZE, entry[0] - offset)
+                tasks.append((verify_file_range, (rel_path, os.path.join(source_dir, rel_path), backup_path,
+                                                  offset, length), length, source_dir))
+        flush_batch(verify_file_range)
+        return tasks, mismatches, skipped
+
+    def estimate_planned_size(self, plan):
+        # 只按清单估算需要拷贝或压缩的字节数：没有清单或目标不存在时是全部文件，否则是清单中有变化的文件
+        # 压缩包中未变化的条目原样拷贝，不计入；内容校验等更精确的判断在处理到这个备份项时修正
+        entries = plan['entries']
+        manifest = plan['manifest']
+        if not entries:
+            return 0
+        if not manifest.loaded or not os.path.exists(plan['destination']):
+            return sum(entry[0] for entry in entries.values())
+        return sum(entry[0] for rel_path, entry in entries.items() if manifest.is_changed(rel_path, entry))
+
+    def measure(self, target, phase, files=1, size=0, path=None):
+        # 性能统计：计时备份目标的一个阶段，没有开启统计时返回不计时的上下文管理器
+        if self.metrics is None:
+            return NULL_MEASURE
+        return self.metrics.measure(target, phase, files, size, path)
+
+    def record_metric(self, target, phase, start, files=1, size=0):
+        # 性能统计：记录从start（time.perf_counter()）到现在的用时
+        if self.metrics is not None:
+            self.metrics.add(target, phase, time.perf_counter() - start, files, size)
+
+    def save_metrics(self, copy_backend, timestamp):
+        # 保存本次备份的性能统计，并发给界面显示汇总
+        summary = self.metrics.summary(copy_backend)
+        metrics_path = os.path.join(self.backup_root, MANIFEST_DIR_NAME, METRICS_DIR_NAME, f"{timestamp}.json")
+        try:
+            os.makedirs(os.path.dirname(metrics_path), exist_ok=True)
+            with open(metrics_path, 'w', encoding='utf-8') as file:
+                json.dump(summary, file, ensure_ascii=False, indent=1)
+        except OSError as e:
+            self.log_message(f"保存性能统计出错: {e}")
+            metrics_path = None
+        else:
+            self.log_message(f"性能统计已保存到 {metrics_path}")
+        self.events.put(MetricsEvent(metrics_path, summary))
+
+    def advance_plan(self, plan, size):
+        # 备份项拷贝或压缩了size字节，计入这个备份项和总进度；可在多个拷贝线程中同时调用
+        with plan['lock']:
+            plan['done'] += size
+        self.progress.advance(size)
+
+    def open_chunk_store(self):
+        # 多个去重备份项共用一个块存储，第一次用到时打开
+        with self.chunk_store_lock:
+            if self.chunk_store is None:
+                self.chunk_store = ChunkStore.open(os.path.join(self.backup_root, CHUNK_STORE_DIR_NAME))
+            return self.chunk_store
+
+    def plan_devices(self, plan):
+        # 备份项的源和目标所在的设备，调度器按设备限制并发
+        devices = {path_device(plan['item']['path']), path_device(plan['destination'])}
+        devices.discard(None)
+        return devices
+
+    def replan(self, plan, size):
+        # 把备份项的计划字节数修正为size
+        self.progress.plan(size - plan['planned'])
+        plan['planned'] = size
+
+    def size_to_string(self, size, total_size):
+        if total_size < 1024:
+            return "{}B".format(size)
+        elif total_size < 1024 ** 2:
+            return "{:.2f}KB".format(size / 1024)
+        elif total_size < 1024 ** 3:
+            return "{:.2f}MB".format(size / 1024**2)
+        else:
+            return "{:.2f}GB".format(size / 1024**3)
+        
+    def get_backup_destination(self, source):
+        return os.path.join(self.backup_root, os.path.relpath(source, start=os.path.dirname(source)))
+
+    def get_item_destination(self, item):
+        # 备份项在备份根目录下的位置：压缩包、去重索引目录、快照目录或直接拷贝的目录/文件
+        destination = self.get_backup_destination(item['path'])
+        if item['is_dir'] and item['zip']:
+            return destination + '.zip'
+        if item.get('dedup'):
+            return os.path.join(self.backup_root, CHUNK_STORE_DIR_NAME,
+                                os.path.basename(destination) + CHUNK_INDEX_DIR_SUFFIX)
+        if item.get('snapshot'):
+            return destination + SNAPSHOT_DIR_SUFFIX
+        return destination
+
+    def get_manifest_path(self, destination):
+        return os.path.join(self.backup_root, MANIFEST_DIR_NAME, os.path.basename(destination) + '.json')
+
+    def get_journal_path(self, destination):
+        return os.path.join(self.backup_root, MANIFEST_DIR_NAME, os.path.basename(destination) + '.journal')
+
+    def get_hash_cache_path(self, destination):
+        return os.path.join(self.backup_root, MANIFEST_DIR_NAME, os.path.basename(destination) + '.hashes.json')
+
+    def get_block_cache_path(self, destination):
+        return os.path.join(self.backup_root, MANIFEST_DIR_NAME, os.path.basename(destination) + '.blocks.json')
+
+    def scan_backup_items(self):
+        # 为每个备份项扫描一次源目录，并载入上次备份时保存的清单
+        # 取消时停止扫描，返回已经扫描的部分，调度器不会再开始新的备份项
+        plans = []
+        for item in self.backup_items:
+            if self.is_canceled():
+                break
+            source = item['path']
+            if self.dirty_paths is not None and source not in self.dirty_paths:
+                continue
+            destination = self.get_item_destination(item)
+            manifest = FileManifest.load(self.get_manifest_path(destination), source)
+            journal_path = self.get_journal_path(destination)
+            resume_snapshot, resumed = RunJournal.read(journal_path, source)
+            if resumed and not item.get('snapshot') and not item.get('dedup'):
+                # 上次备份中断前已经拷贝完成的文件并入清单，这次不再拷贝
+                manifest.files.update(resumed)
+                manifest.loaded = True
+            dirty = self.dirty_paths.get(source) if self.dirty_paths is not None else None
+            # 内容校验的摘要缓存和镜像模式的改名识别要用inode区分文件
+            need_inode = bool(item.get('hash_check') or item.get('mirror'))
+            unreadable = []
+
+            def on_error(rel_dir, e, source=source, unreadable=unreadable):
+                unreadable.append(rel_dir)
+                self.log_message(f"无法读取目录 {os.path.join(source, rel_dir)}，跳过: {e}")
+
+            scan_start = time.perf_counter()
+            try:
+                if dirty is not None and manifest.loaded and item['is_dir'] and os.path.isdir(source):
+                    # 清单就是上次备份时的扫描结果，只需更新变化的路径
+                    entries = rescan_paths(source, manifest.files, dirty, PathRules.for_item(item),
+                                           need_inode, on_error, self.is_canceled)
+                    self.record_metric(source, 'rescan', scan_start, len(dirty))
+                else:
+                    entries = scan_tree(source, PathRules.for_item(item), need_inode, on_error, self.is_canceled)
+                    self.record_metric(source, 'scan', scan_start, len(entries or ()))
+            except BackupCanceled:
+                break
+            except OSError as e:
+                self.show_warning("错误", f"扫描 {source} 时出错，跳过这个备份目标: {e}")
+                self.log_message(f"扫描 {source} 时出错: {e}")
+                continue
+            if unreadable and entries is not None:
+                # 无法读取的目录下的文件沿用上次的备份，不当作已删除，也不重新拷贝
+                for rel_path, entry in manifest.files.items():
+                    if any(rel_path.startswith(rel_dir) for rel_dir in unreadable):
+                        entries.setdefault(rel_path, entry)
+                self.show_warning("警告", f"{source} 中有 {len(unreadable)} 个目录无法读取，这些目录沿用上次的备份")
+            plans.append({
+                'item': item,
+                'destination': destination,
+                'entries': entries,
+                'manifest': manifest,
+                'journal': RunJournal(journal_path),
+                'resumed': resumed,  # 上次中断前已完成的文件
+                'resume_snapshot': resume_snapshot,  # 上次中断时未完成的快照目录名
+                # 内容校验模式才载入摘要缓存
+                'hash_cache': (HashCache.load(self.get_hash_cache_path(destination))
+                               if item.get('hash_check') else None),
+                # 增量拷贝只用于直接拷贝的目标，快照中的文件与旧快照硬链接，不能原位修改
+                'block_cache': (BlockDigestCache.load(self.get_block_cache_path(destination))
+                                if item.get('delta') and not item['zip'] and not item.get('snapshot')
+                                and not item.get('dedup') else None),
+                'touched': 0,  # 内容未变、只有修改时间变化的文件数
+                'done': 0,  # 这个备份项已拷贝或压缩的字节数
+                'lock': threading.Lock(),
+            })
+        return plans
+
+    def save_manifest(self, plan):
+        with self.measure(plan['item']['path'], 'manifest', files=len(plan['manifest'].files)):
+            plan['manifest'].save()
+            if plan['hash_cache'] is not None:
+                plan['hash_cache'].save(plan['manifest'].files.values())
+            if plan['block_cache'] is not None:
+                plan['block_cache'].save(plan['manifest'].files)
+            plan['journal'].discard()
+
+    def plan_changes(self, plan):
+        # 返回需要拷贝的相对路径列表；压缩目标只要有变化就返回全部文件
+        entries = plan['entries']
+        destination = plan['destination']
+        manifest = plan['manifest']
+        item = plan['item']
+        # 如果目标不存在，那么认为全部需要更新
+        if not os.path.exists(destination):
+            return list(entries)
+        if manifest.loaded:
+            changed = [rel_path for rel_path, entry in entries.items() if manifest.is_changed(rel_path, entry)]
+            if plan['hash_cache'] is not None:
+                changed = self.filter_touched_files(plan, changed)
+            # 压缩包里有源中已删除的文件，或者压缩设置改变时，也需要重新压缩
+            if item['is_dir'] and item['zip'] and (changed or len(manifest.files) != len(entries) or
+                                                   manifest.compression != CompressionPolicy.for_item(item).settings()):
+                return list(entries)
+            return changed
+        # 没有清单时退回到与目标比较修改时间
+        if item['is_dir'] and item['zip']:
+            zip_mtime = os.stat(destination).st_mtime
+            if any(entry[1] > zip_mtime for entry in entries.values()):
+                return list(entries)
+            return []
+        if not item['is_dir']:
+            return list(entries) if next(iter(entries.values()))[1] > os.stat(destination).st_mtime else []
+        # 目标目录也只遍历一次，目标位置不存在的文件是新增的，也是需要更新的
+        dest_entries = scan_tree(destination)
+        return [rel_path for rel_path, entry in entries.items()
+                if rel_path not in dest_entries or entry[1] > dest_entries[rel_path][1]]
+
+    def backup_snapshot(self, plan, copier):
+        # 快照模式（类似rsync --link-dest）：每次备份在 目标名_快照/时间戳/ 下生成完整的目录树，
+        # 未变化的文件硬链接到上一个快照，只有变化的文件占用新的空间；返回是否生成了新快照
+        item = plan['item']
+        entries = plan['entries']
+        manifest = plan['manifest']
+        snapshot_root = plan['destination']
+        source_dir = item['path'] if item['is_dir'] else os.path.dirname(item['path'])
+
+        previous = None
+        if manifest.loaded and manifest.snapshot:
+            previous = os.path.join(snapshot_root, manifest.snapshot)
+            if not os.path.isdir(previous):
+                previous = None
+        if previous is not None:
+            changed = [rel_path for rel_path, entry in entries.items() if manifest.is_changed(rel_path, entry)]
+            if plan['hash_cache'] is not None:
+                changed = self.filter_touched_files(plan, changed)
+            # 没有新增、修改和删除的文件时，上一个快照就是当前状态，不再生成新快照
+            if not changed and set(manifest.files) == set(entries):
+                if plan['touched']:
+                    manifest.files = entries
+                    self.save_manifest(plan)
+                if plan['resume_snapshot']:
+                    # 上次中断的快照已经没有意义
+                    shutil.rmtree(os.path.join(snapshot_root, plan['resume_snapshot']), ignore_errors=True)
+                    plan['journal'].discard()
+                return False
+        else:
+            changed = list(entries)
+
+        # 上次中断的快照还在时继续填充它，日志中记录过且之后没有变化的文件不再处理
+        done = {}
+        resume = plan['resume_snapshot']
+        if resume and resume != manifest.snapshot and os.path.isdir(os.path.join(snapshot_root, resume)):
+            name = resume
+            done = {rel_path: entry for rel_path, entry in plan['resumed'].items() if entries.get(rel_path) == entry}
+            changed = [rel_path for rel_path in changed if rel_path not in done]
+        else:
+            name = datetime.now().strftime("%Y%m%d_%H%M%S")
+            if os.path.exists(os.path.join(snapshot_root, name)):
+                name = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+        snapshot_dir = os.path.join(snapshot_root, name)
+        changed_set = set(changed)
+        linked_count = 0
+        # 未完成的快照不在清单中，不会被当作下次硬链接的基础；中断时保留，由进度日志记录已完成的文件
+        plan['journal'].start(item['path'], name, done)
+        try:
+            link_start = time.perf_counter()
+            made_dirs = set()
+            for rel_path in entries:
+                if rel_path in changed_set or rel_path in done:
+                    continue
+                if self.is_canceled():
+                    raise BackupCanceled()
+                dest_path = os.path.join(snapshot_dir, rel_path)
+                target_dir = os.path.dirname(dest_path)
+                if target_dir not in made_dirs:
+                    os.makedirs(target_dir, exist_ok=True)
+                    made_dirs.add(target_dir)
+                try:
+                    if os.path.lexists(dest_path):
+                        os.remove(dest_path)  # 上次中断时留下的、之后又变化了的文件
+                    os.link(os.path.join(previous, rel_path), dest_path)
+                    plan['journal'].record(rel_path, entries[rel_path])
+                    linked_count += 1
+                except OSError:
+                    # 文件系统不支持硬链接、链接数已满或上一个快照中的文件丢失时，改为从源拷贝
+                    changed.append(rel_path)
+            os.makedirs(snapshot_dir, exist_ok=True)
+            self.record_metric(item['path'], 'link', link_start, linked_count)
+
+            # 链接失败改为拷贝的文件也计入计划字节数
+            self.replan(plan, sum(entries[rel_path][0] for rel_path in changed))
+            for rel_path, digest in copier.copy_tree_files(source_dir, snapshot_dir, changed,
+                                                           plan['hash_cache'] is not None):
+                plan['journal'].record(rel_path, entries[rel_path])
+                if digest is not None:
+                    plan['hash_cache'].put(entries[rel_path], digest)
+                self.log_message(f"备份文件：{os.path.join(source_dir, rel_path)} 至 {os.path.join(snapshot_dir, rel_path)}")
+        finally:
+            plan['journal'].close()
+
+        manifest.files = entries
+        manifest.snapshot = name
+        self.save_manifest(plan)
+        self.log_message(f"生成快照 {snapshot_dir}：硬链接 {linked_count} 个未变化的文件，拷贝 {len(changed)} 个文件")
+        return True
+
+    def mirror_deletions(self, plan, recycle_bin):
+        # 比较上次备份的清单和这次的扫描结果：清单中有而源中已没有的文件，如果能在新增的文件中找到它，
+        # 说明是改名或移动，在备份中直接改名；找不到的移入回收站。只处理变化的文件，不需要扫描备份目录
+        entries = plan['entries']
+        manifest = plan['manifest']
+        hash_cache = plan['hash_cache']
+        source = plan['item']['path']
+        destination = plan['destination']
+        deleted = [rel_path for rel_path in manifest.files if rel_path not in entries]
+        if not deleted:
+            return
+        added = [rel_path for rel_path in entries if rel_path not in manifest.files]
+        # 改名和同一文件系统内的移动不改变inode、大小和修改时间
+        by_inode = {(entries[rel_path][2], entries[rel_path][0], entries[rel_path][1]): rel_path
+                    for rel_path in added if entries[rel_path][2]}
+        # 内容校验模式下再按内容摘要匹配大小相同的新增文件，例如被另存为新文件后删除了旧文件
+        by_size = {}
+        if hash_cache is not None:
+            for rel_path in added:
+                by_size.setdefault(entries[rel_path][0], []).append(rel_path)
+        matched = set()
+        renamed_count = 0
+        removed_count = 0
+        for old_path in deleted:
+            if self.is_canceled():
+                raise BackupCanceled()
+            old_entry = manifest.files.pop(old_path)
+            new_path = by_inode.get((old_entry[2], old_entry[0], old_entry[1]))
+            if new_path is None and hash_cache is not None:
+                new_path = self.find_renamed_by_digest(plan, old_entry, by_size.get(old_entry[0], ()), matched)
+            old_file = os.path.join(destination, old_path)
+            if new_path is not None and new_path not in matched and self.destination_exists(old_file):
+                matched.add(new_path)
+                new_file = os.path.join(destination, new_path)
+                if self.destination_exists(new_file):
+                    with self.measure(source, 'recycle'):
+                        move_into_recycle_bin(new_file, recycle_bin, self.backup_root, self.dest_index)
+                if self.dest_index is not None:
+                    self.dest_index.makedirs(os.path.dirname(new_file))
+                    os.replace(old_file, new_file)
+                    self.dest_index.discard(old_file)
+                    self.dest_index.add_file(new_file)
+                else:
+                    os.makedirs(os.path.dirname(new_file), exist_ok=True)
+                    os.replace(old_file, new_file)
+                manifest.files[new_path] = entries[new_path]
+                renamed_count += 1
+                self.log_message(f"镜像改名：{old_file} 为 {new_file}")
+            elif self.destination_exists(old_file):
+                with self.measure(source, 'recycle'):
+                    move_into_recycle_bin(old_file, recycle_bin, self.backup_root, self.dest_index)
+                removed_count += 1
+                self.log_message(f"镜像删除：{old_file} 已移入回收站")
+            else:
+                continue
+            # 删除变空的上级目录，直到备份目标目录为止
+            parent = os.path.dirname(old_file)
+            while parent != destination and parent.startswith(destination + os.sep):
+                try:
+                    os.rmdir(parent)
+                except OSError:
+                    break
+                if self.dest_index is not None:
+                    self.dest_index.discard(parent)
+                parent = os.path.dirname(parent)
+        self.save_manifest(plan)
+        self.log_message(f"镜像：改名 {renamed_count} 个文件，删除 {removed_count} 个文件：{source}")
+
+    def destination_exists(self, path):
+        # 网络目标模式下从目标目录索引回答，不再逐个查询
+        if self.dest_index is not None:
+            return self.dest_index.exists(path)
+        return os.path.exists(path)
+
+    def find_renamed_by_digest(self, plan, old_entry, candidates, matched):
+        # 在大小相同的新增文件中找内容摘要与被删除文件相同的，摘要记入缓存，之后的变更检测不用再算
+        hash_cache = plan['hash_cache']
+        old_digest = hash_cache.get(old_entry)
+        if old_digest is None:
+            return None
+        for rel_path in candidates:
+            if rel_path in matched:
+                continue
+            entry = plan['entries'][rel_path]
+            digest = hash_cache.get(entry)
+            if digest is None:
+                file_path = os.path.join(plan['item']['path'], rel_path)
+                with self.measure(plan['item']['path'], 'hash', size=entry[0], path=file_path):
+                    digest = file_digest(file_path, self.is_canceled)
+                hash_cache.put(entry, digest)
+            if digest == old_digest:
+                return rel_path
+        return None
+
+    def backup_chunk_store(self, plan, store):
+        # 去重块存储：变化的文件按内容切块，只写入块存储中还没有的块；每次备份在索引目录下生成一份完整的文件索引，
+        # 还原时按索引拼接数据块。未变化的文件沿用上一份索引中的块列表，不需要读取；返回是否生成了新索引
+        item = plan['item']
+        entries = plan['entries']
+        manifest = plan['manifest']
+        index_dir = plan['destination']
+        source_dir = item['path'] if item['is_dir'] else os.path.dirname(item['path'])
+
+        previous = None
+        if manifest.loaded and manifest.snapshot:
+            previous = load_chunk_index(os.path.join(index_dir, manifest.snapshot))
+        previous = previous or {}
+        changed = [rel_path for rel_path, entry in entries.items()
+                   if rel_path not in previous or previous[rel_path][:3] != entry]
+        if previous and not changed and set(previous) == set(entries):
+            return False
+        self.replan(plan, sum(entries[rel_path][0] for rel_path in changed))
+
+        changed_set = set(changed)
+        files = {rel_path: previous[rel_path] for rel_path in entries if rel_path not in changed_set}
+        new_chunks = 0
+        new_bytes = 0
+        stored_bytes = 0
+        try:
+            for rel_path in changed:
+                chunk_ids = []
+                file_path = os.path.join(source_dir, rel_path)
+                with self.measure(item['path'], 'chunk', size=entries[rel_path][0], path=file_path):
+                    for chunk in iter_file_chunks(file_path, self.is_canceled):
+                        chunk_id, written = store.put(chunk)
+                        chunk_ids.append(chunk_id)
+                        if written:
+                            new_chunks += 1
+                            new_bytes += len(chunk)
+                            stored_bytes += written
+                        self.advance_plan(plan, len(chunk))
+                files[rel_path] = entries[rel_path] + [chunk_ids]
+                self.log_message(f"备份文件：{os.path.join(source_dir, rel_path)} 至块存储")
+        finally:
+            # 已写入的块即使中途取消也记入块索引，下次可以直接复用
+            store.save()
+
+        os.makedirs(index_dir, exist_ok=True)
+        name = datetime.now().strftime("%Y%m%d_%H%M%S") + '.json'
+        if os.path.exists(os.path.join(index_dir, name)):
+            name = datetime.now().strftime("%Y%m%d_%H%M%S_%f") + '.json'
+        index_path = os.path.join(index_dir, name)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as file:
+            json.dump({'source': item['path'], 'files': files}, file, ensure_ascii=False)
+        os.replace(index_path + '.tmp', index_path)
+
+        manifest.files = entries
+        manifest.snapshot = name
+        self.save_manifest(plan)
+        self.log_message(f"生成索引 {index_path}：{len(changed)} 个文件有变化，新增 {new_chunks} 个数据块 "
+                         f"{new_bytes / 1024 ** 2:.2f}MB（压缩后 {stored_bytes / 1024 ** 2:.2f}MB），其余数据已在块存储中")
+        return True
+
+    def filter_touched_files(self, plan, changed):
+        # 内容校验模式：大小不变、只有修改时间变化的文件比较内容摘要，内容相同的只更新清单，不再拷贝
+        # 只有大小或修改时间与清单不同的文件才需要计算摘要；旧摘要未知时按有变化处理，不会漏掉真正的修改
+        entries = plan['entries']
+        manifest = plan['manifest']
+        hash_cache = plan['hash_cache']
+        source = plan['item']['path']
+        really_changed = []
+        for rel_path in changed:
+            entry = entries[rel_path]
+            old_entry = manifest.files.get(rel_path)
+            old_digest = hash_cache.get(old_entry) if old_entry is not None and old_entry[0] == entry[0] else None
+            if old_digest is None:
+                really_changed.append(rel_path)
+                continue
+            digest = hash_cache.get(entry)
+            if digest is None:
+                file_path = os.path.join(source, rel_path) if plan['item']['is_dir'] else source
+                with self.measure(plan['item']['path'], 'hash', size=entry[0], path=file_path):
+                    digest = file_digest(file_path, self.is_canceled)
+                hash_cache.put(entry, digest)
+            if digest == old_digest:
+                manifest.files[rel_path] = entry
+                plan['touched'] += 1
+            else:
+                really_changed.append(rel_path)
+        if plan['touched']:
+            self.log_message(f"内容校验：{plan['touched']} 个文件只有修改时间变化，内容相同，跳过：{source}")
+        return really_changed
+
+    def open_previous_zip(self, destination_zip, manifest, policy):
+        # 打开上次备份的压缩包用于增量更新，没有可信的清单、压缩设置改变或压缩包损坏时返回None，改为完整压缩
+        if not manifest.loaded or not os.path.exists(destination_zip):
+            return None
+        if manifest.compression != policy.settings():
+            self.log_message(f"压缩设置已改变（{manifest.compression} -> {policy.settings()}），重新压缩全部文件")
+            return None
+        try:
+            return zipfile.ZipFile(destination_zip, 'r')
+        except (OSError, zipfile.BadZipFile) as e:
+            self.log_message(f"旧压缩包无法读取，将完整重新压缩：{e}")
+            return None
+
+    def zip_directory(self, source_dir, destination_zip, entries, recycle_bin, manifest, hash_cache=None,
+                      progress=None, policy=None):
+        # 实现目录压缩的方法，按扫描得到的清单压缩，不再重新遍历
+        # 增量更新：清单显示未变化的文件直接拷贝旧压缩包里已压缩的数据，只压缩新增或修改的文件
+        # 需要压缩的文件由多个线程并行压缩，按清单顺序写入
+        # 先写到临时文件，压缩成功后才把旧压缩包移入回收站，取消或出错时旧的备份保持不变
+        temp_zip = destination_zip + '.tmp'
+        if policy is None:
+            policy = CompressionPolicy(store_incompressible=False)
+        old_zip = self.open_previous_zip(destination_zip, manifest, policy)
+        reused_count = 0
+        try:
+            with zipfile.ZipFile(temp_zip, 'w', zipfile.ZIP_DEFLATED) as zipf, \
+                    self.measure(source_dir, 'compress', len(entries), sum(entry[0] for entry in entries.values())):
+                old_file = open(destination_zip, 'rb') if old_zip is not None else None
+                try:
+                    tasks = []
+                    for rel_path, entry in entries.items():
+                        arcname = rel_path.replace(os.sep, '/')
+                        old_info = old_zip.NameToInfo.get(arcname) if old_zip is not None else None
+                        if old_info is not None and not manifest.is_changed(rel_path, entry):
+                            tasks.append(('copy', old_info))
+                            reused_count += 1
+                        else:
+                            tasks.append(('compress', os.path.join(source_dir, rel_path), arcname))
+                    writer = ParallelZipWriter(zipf, self.compress_workers, self.is_canceled, policy,
+                                               hash_files=hash_cache is not None, progress=progress)
+                    writer.write(tasks, old_file)
+                    # 内容校验模式下记录新压缩文件的摘要
+                    for rel_path, entry in entries.items():
+                        digest = writer.digests.get(rel_path.replace(os.sep, '/'))
+                        if digest is not None:
+                            hash_cache.put(entry, digest)
+                finally:
+                    if old_file is not None:
+                        old_file.close()
+                        old_zip.close()
+        except BackupCanceled:
+            os.remove(temp_zip)
+            raise
+        except Exception as e:
+            if os.path.exists(temp_zip):
+                os.remove(temp_zip)
+            self.show_warning("错误", f"压缩目录时出错: {e}")
+            self.log_message(f"压缩目录时出错: {e}")
+            return False
+        if reused_count:
+            self.log_message(f"增量压缩：复用 {reused_count} 个未变化的条目，压缩 {len(entries) - reused_count} 个文件")
+        manifest.compression = policy.settings()
+        if policy.stored_count:
+            self.log_message(f"压缩方式 {policy.method}：{policy.stored_count} 个已压缩格式的文件直接存储，不再压缩")
+        if os.path.exists(destination_zip):
+            with self.measure(source_dir, 'recycle'):
+                self.move_to_recycle_bin(destination_zip, recycle_bin)
+        os.replace(temp_zip, destination_zip)
+        return True
+
+    def move_to_recycle_bin(self, target, recycle_bin):
+        try:
+            # 实现移动文件到回收站的方法
+            move_into_recycle_bin(target, recycle_bin, self.backup_root)
+        except Exception as e:
+            self.show_warning("错误", f"移动文件到回收站时出错: {e}")
+            self.log_message(f"移动文件到回收站时出错: {e}")
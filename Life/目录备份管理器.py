@@ -5,14 +5,26 @@ from tkinter import messagebox
 
 # 备份
 import os
-import shutil
-import time
-import zipfile
-from datetime import datetime
+import queue
+import threading
 
 import tkinter.ttk as ttk  # 导入ttk模块，用于进度条
 
-# 备份工具，不支持原目录删除时备份也删除，这种情况请手动删除重新备份！
+from 目录备份引擎 import (BackupEngine, LogEvent, ProgressEvent, WarningEvent, FinishedEvent, MetricsEvent, RotatingLogFile,
+                    ThroughputEstimator, format_log_record, DEFAULT_COPY_WORKERS, DEFAULT_COMPRESS_WORKERS,
+                    DEFAULT_ITEM_WORKERS, DEFAULT_DEVICE_CONCURRENCY,
+                    COMPRESSION_METHODS, DEFAULT_COMPRESSION,
+                    MANIFEST_DIR_NAME, LOG_FILE_NAME)
+
+# 备份工具，默认不会因为原目录删除了文件而删除备份；需要备份与源保持一致时，为备份目标启用镜像模式
+# 不需要界面的定时备份请使用 目录备份命令行.py
+
+EVENT_POLL_INTERVAL_MS = 50  # 界面从事件队列取事件的间隔，积累的日志也按这个频率批量刷新到界面
+MAX_LOG_LINES = 1000  # 日志窗口最多保留的行数，更早的日志只在日志文件中
+# 性能统计汇总中各阶段的显示名称
+PHASE_NAMES = {'scan': '扫描', 'rescan': '重新检查', 'hash': '内容摘要', 'copy': '拷贝', 'delta': '增量拷贝',
+               'compress': '压缩', 'link': '硬链接', 'chunk': '切块去重', 'recycle': '移入回收站', 'manifest': '保存清单'}
+
 
 class BackupManagerGUI(tk.Tk):
     
@@ -24,6 +36,16 @@ class BackupManagerGUI(tk.Tk):
         self.total_size = 0  # 新增：备份项目的总大小
         self.completed_size = 0
         self.config_path = 'backup_config.json'  # 自动保存的配置文件路径
+        self.copy_workers = DEFAULT_COPY_WORKERS
+        self.compress_workers = DEFAULT_COMPRESS_WORKERS
+        # 同时进行的备份目标数和每块磁盘上的并发数，界面上不提供设置，可在backup_config.json中修改
+        self.item_workers = DEFAULT_ITEM_WORKERS
+        self.device_concurrency = DEFAULT_DEVICE_CONCURRENCY
+        self.recycle_max_size_gb = 0  # 回收站总大小上限，0为不限
+        self.recycle_max_age_days = 0  # 回收站保留天数，0为不限
+        self.backup_engine = None  # 正在运行的备份引擎
+        self.verifying = False  # 当前运行的是校验而不是备份
+        self.backup_log_file = None  # 备份期间写入的轮换日志文件
         self.create_widgets()
         self.load_settings()  # 启动时自动载入设置
 
@@ -61,12 +83,57 @@ class BackupManagerGUI(tk.Tk):
         self.start_backup_button = tk.Button(self, text="开始备份", command=self.start_backup)
         self.start_backup_button.grid(row=2, column=2, sticky='e')
 
+        self.verify_backup_button = tk.Button(self, text="校验备份", command=self.start_verify)
+        self.verify_backup_button.grid(row=2, column=1, sticky='e')
+
         self.export_settings_button = tk.Button(self, text="导出设置", command=self.export_settings)
         self.export_settings_button.grid(row=3, column=0, sticky='w')
 
         self.import_settings_button = tk.Button(self, text="导入设置", command=self.import_settings)
         self.import_settings_button.grid(row=3, column=2, sticky='e')
 
+        # 并行拷贝和并行压缩的线程数设置
+        self.copy_workers_frame = tk.Frame(self)
+        self.copy_workers_frame.grid(row=3, column=1)
+        self.copy_workers_label = tk.Label(self.copy_workers_frame, text="并行拷贝数:")
+        self.copy_workers_label.pack(side="left")
+        self.copy_workers_spinbox = tk.Spinbox(self.copy_workers_frame, from_=1, to=64, width=5,
+                                               command=self.update_copy_workers)
+        self.copy_workers_spinbox.pack(side="left")
+        self.compress_workers_label = tk.Label(self.copy_workers_frame, text="并行压缩数:")
+        self.compress_workers_label.pack(side="left")
+        self.compress_workers_spinbox = tk.Spinbox(self.copy_workers_frame, from_=1, to=64, width=5,
+                                                   command=self.update_copy_workers)
+        self.compress_workers_spinbox.pack(side="left")
+        self.set_copy_workers_spinbox()
+        # 开启后记录每个备份目标各阶段的用时，备份结束后显示汇总
+        self.collect_metrics = tk.BooleanVar(value=False)
+        self.collect_metrics_checkbutton = tk.Checkbutton(self.copy_workers_frame, text="性能统计",
+                                                          variable=self.collect_metrics,
+                                                          command=self.auto_save_settings)
+        self.collect_metrics_checkbutton.pack(side="left")
+        # 备份根目录在NAS/SMB等网络位置时开启，批量列出目标目录，减少逐个文件的网络往返
+        self.remote_destination = tk.BooleanVar(value=False)
+        self.remote_destination_checkbutton = tk.Checkbutton(self.copy_workers_frame, text="网络目标",
+                                                             variable=self.remote_destination,
+                                                             command=self.auto_save_settings)
+        self.remote_destination_checkbutton.pack(side="left")
+
+        # 回收站保留策略：所有回收站的总大小上限和保留天数，0为不限，超出时备份结束后从最旧的回收站开始删除
+        self.recycle_frame = tk.Frame(self)
+        self.recycle_frame.grid(row=4, column=1, columnspan=2, sticky='e')
+        self.recycle_max_size_label = tk.Label(self.recycle_frame, text="回收站上限(GB):")
+        self.recycle_max_size_label.pack(side="left")
+        self.recycle_max_size_spinbox = tk.Spinbox(self.recycle_frame, from_=0, to=100000, width=7,
+                                                   command=self.update_recycle_retention)
+        self.recycle_max_size_spinbox.pack(side="left")
+        self.recycle_max_age_label = tk.Label(self.recycle_frame, text="保留天数:")
+        self.recycle_max_age_label.pack(side="left")
+        self.recycle_max_age_spinbox = tk.Spinbox(self.recycle_frame, from_=0, to=36500, width=6,
+                                                  command=self.update_recycle_retention)
+        self.recycle_max_age_spinbox.pack(side="left")
+        self.set_recycle_retention_spinbox()
+
         self.create_log_widgets()
         
     def select_backup_root(self):
@@ -77,24 +144,96 @@ class BackupManagerGUI(tk.Tk):
         self.backup_root = directory
         self.auto_save_settings()  # 选择后自动保存设置
 
-    def auto_save_settings(self):
-        # 修改此方法以包含备份根目录
-        config = {
+    def set_copy_workers_spinbox(self):
+        self.copy_workers_spinbox.delete(0, 'end')
+        self.copy_workers_spinbox.insert(0, self.copy_workers)
+        self.compress_workers_spinbox.delete(0, 'end')
+        self.compress_workers_spinbox.insert(0, self.compress_workers)
+
+    def set_recycle_retention_spinbox(self):
+        self.recycle_max_size_spinbox.delete(0, 'end')
+        self.recycle_max_size_spinbox.insert(0, self.recycle_max_size_gb)
+        self.recycle_max_age_spinbox.delete(0, 'end')
+        self.recycle_max_age_spinbox.insert(0, self.recycle_max_age_days)
+
+    def update_recycle_retention(self):
+        # 读取回收站的大小上限和保留天数，输入无效时恢复为当前值
+        try:
+            self.recycle_max_size_gb = max(0, int(self.recycle_max_size_spinbox.get()))
+            self.recycle_max_age_days = max(0, int(self.recycle_max_age_spinbox.get()))
+        except ValueError:
+            self.set_recycle_retention_spinbox()
+            return
+        self.auto_save_settings()
+
+    def update_copy_workers(self):
+        # 读取并行拷贝数和并行压缩数，输入无效时恢复为当前值
+        try:
+            self.copy_workers = max(1, int(self.copy_workers_spinbox.get()))
+            self.compress_workers = max(1, int(self.compress_workers_spinbox.get()))
+        except ValueError:
+            self.set_copy_workers_spinbox()
+            return
+        self.auto_save_settings()
+
+    def current_settings(self):
+        # 自动保存和导出共用的设置内容，新增设置项只需在这里和apply_settings中各加一处
+        return {
             'backup_root': self.backup_root,
-            'backup_items': self.backup_items
+            'backup_items': self.backup_items,
+            'copy_workers': self.copy_workers,
+            'compress_workers': self.compress_workers,
+            'item_workers': self.item_workers,
+            'device_concurrency': self.device_concurrency,
+            'collect_metrics': self.collect_metrics.get(),
+            'remote_destination': self.remote_destination.get(),
+            'recycle_max_size_gb': self.recycle_max_size_gb,
+            'recycle_max_age_days': self.recycle_max_age_days
         }
+
+    def apply_settings(self, config):
+        # 启动时载入和导入共用：把配置中的设置应用到界面
+        self.backup_root = config.get('backup_root', '')
+        self.backup_items = config.get('backup_items', [])
+        self.copy_workers = config.get('copy_workers', DEFAULT_COPY_WORKERS)
+        self.compress_workers = config.get('compress_workers', DEFAULT_COMPRESS_WORKERS)
+        self.item_workers = config.get('item_workers', DEFAULT_ITEM_WORKERS)
+        self.device_concurrency = config.get('device_concurrency', DEFAULT_DEVICE_CONCURRENCY)
+        self.collect_metrics.set(config.get('collect_metrics', False))
+        self.remote_destination.set(config.get('remote_destination', False))
+        self.recycle_max_size_gb = config.get('recycle_max_size_gb', 0)
+        self.recycle_max_age_days = config.get('recycle_max_age_days', 0)
+        self.set_recycle_retention_spinbox()
+        self.set_copy_workers_spinbox()
+        self.backup_root_entry.delete(0, 'end')
+        self.backup_root_entry.insert(0, self.backup_root)
+        self.update_listbox_with_backup_items()
+
+    def auto_save_settings(self):
+        # 修改此方法以包含备份根目录
         with open(self.config_path, 'w') as file:
-            json.dump(config, file, indent=4)
+            json.dump(self.current_settings(), file, indent=4)
 
     def add_backup_target(self):
         # 修改此方法以添加文件或目录为备份目标
         def add_item(target, is_dir):
-            zip_option = messagebox.askyesno("选择", "是否为这个备份目标启用压缩?") if is_dir else False
-            self.backup_items.append({"path": target, "zip": zip_option, "is_dir": is_dir})
-            display_text = "{} ({}, {})".format(target, "压缩" if zip_option else "不压缩", "目录" if is_dir else "文件")
+            item = self.ask_target_options(target, is_dir)
+            if item is None:
+                return  # 在选项窗口中取消
+            self.backup_items.append(item)
+            compression = item.get("compression", DEFAULT_COMPRESSION)
+            display_text = "{} ({}, {}{}{}{}{}{}{})".format(target, "压缩" + (
+                                                             "" if compression == DEFAULT_COMPRESSION else f"({compression})")
+                                                         if item["zip"] else "不压缩", "目录" if is_dir else "文件",
+                                                         ", 去重存储" if item["dedup"] else "",
+                                                         ", 内容校验" if item["hash_check"] else "",
+                                                         ", 快照" if item["snapshot"] else "",
+                                                         ", 镜像" if item["mirror"] else "",
+                                                         ", 增量拷贝" if item["delta"] else "",
+                                                       ", 有过滤规则" if item.get("exclude") or item.get("include") else "")
             self.targets_listbox.insert('end', display_text)
             self.auto_save_settings()  # 添加后自动保存设置
-        
+
         target_type = messagebox.askquestion("添加备份目标", "添加目录吗？选否的话添加文件", type='yesno', icon='question', default='yes')
         if target_type == 'yes':
             target = filedialog.askdirectory()  # 添加目录
@@ -105,6 +244,86 @@ class BackupManagerGUI(tk.Tk):
             if target:
                 add_item(target, False)
 
+    def ask_target_options(self, target, is_dir):
+        # 备份目标的选项窗口：所有选项在一个窗口中设置，与当前选择冲突或不适用的选项变为不可选
+        # 返回备份项字典，关闭窗口或取消时返回None
+        window = tk.Toplevel(self)
+        window.title("备份目标选项")
+        window.transient(self)
+        tk.Label(window, text=target).grid(row=0, column=0, columnspan=2, sticky='w')
+        options = {}
+        checkbuttons = {}
+        descriptions = [
+            ('zip', "压缩为zip"),
+            ('dedup', "备份到去重块存储（各目标和各次备份间相同的数据只存一份，用命令行 --restore 还原）"),
+            ('hash_check', "内容校验（修改时间变化但内容相同的文件不再重复备份）"),
+            ('snapshot', "快照模式（每次保留带时间戳的完整副本，未变化的文件用硬链接）"),
+            ('mirror', "镜像模式（源中删除的文件也移出备份，改名的文件在备份中直接改名）"),
+            ('delta', "大文件增量拷贝（只改写变化的部分，旧版本不再移入回收站）"),
+        ]
+        for row, (key, text) in enumerate(descriptions, start=1):
+            options[key] = tk.BooleanVar(value=False)
+            checkbuttons[key] = tk.Checkbutton(window, text=text, variable=options[key], anchor='w')
+            checkbuttons[key].grid(row=row, column=0, columnspan=2, sticky='w')
+        row = len(descriptions) + 1
+        # 图片、视频、压缩包等已压缩的文件总是直接存储，这里选择其余文件的压缩方式
+        tk.Label(window, text="压缩方式（deflate_fast最快，lzma压缩率最高但最慢）:").grid(row=row, column=0, sticky='w')
+        compression = tk.StringVar(value=DEFAULT_COMPRESSION)
+        compression_combobox = ttk.Combobox(window, textvariable=compression, values=list(COMPRESSION_METHODS),
+                                            state='readonly', width=14)
+        compression_combobox.grid(row=row, column=1, sticky='w')
+        # 规则之间用分号分隔，之后也可以直接在backup_config.json中修改
+        tk.Label(window, text="排除（用;分隔，如 node_modules;.git;*.tmp;build/）:").grid(row=row + 1, column=0, sticky='w')
+        exclude_entry = tk.Entry(window, width=40)
+        exclude_entry.grid(row=row + 1, column=1, sticky='we')
+        tk.Label(window, text="只备份匹配的文件（用;分隔，如 *.docx;*.xlsx）:").grid(row=row + 2, column=0, sticky='w')
+        include_entry = tk.Entry(window, width=40)
+        include_entry.grid(row=row + 2, column=1, sticky='we')
+
+        def update_states():
+            # 与备份引擎一致：压缩目标不能去重、快照、增量拷贝；去重目标不用摘要缓存；镜像只用于直接拷贝的目录
+            zip_option, dedup = options['zip'].get(), options['dedup'].get()
+            available = {
+                'zip': is_dir and not dedup,
+                'dedup': not zip_option,
+                'hash_check': not dedup,
+                'snapshot': not zip_option and not dedup,
+                'mirror': is_dir and not zip_option and not dedup and not options['snapshot'].get(),
+                'delta': not zip_option and not dedup and not options['snapshot'].get(),
+            }
+            for key, enabled in available.items():
+                if not enabled:
+                    options[key].set(False)
+                checkbuttons[key]['state'] = 'normal' if enabled else 'disabled'
+            compression_combobox['state'] = 'readonly' if options['zip'].get() else 'disabled'
+            for entry in (exclude_entry, include_entry):
+                entry['state'] = 'normal' if is_dir else 'disabled'
+
+        for checkbutton in checkbuttons.values():
+            checkbutton['command'] = update_states
+        update_states()
+
+        result = []
+
+        def confirm():
+            item = {key: var.get() for key, var in options.items()}
+            item.update({"path": target, "is_dir": is_dir})
+            if item["zip"]:
+                item["compression"] = compression.get()
+            if is_dir:
+                item["exclude"] = [p.strip() for p in exclude_entry.get().split(';') if p.strip()]
+                item["include"] = [p.strip() for p in include_entry.get().split(';') if p.strip()]
+            result.append(item)
+            window.destroy()
+
+        buttons = tk.Frame(window)
+        buttons.grid(row=row + 3, column=0, columnspan=2, sticky='e')
+        tk.Button(buttons, text="确定", command=confirm).pack(side="left")
+        tk.Button(buttons, text="取消", command=window.destroy).pack(side="left")
+        window.grab_set()
+        self.wait_window(window)
+        return result[0] if result else None
+
     def remove_backup_target(self):
         # 实现删除备份目标的方法
         selected_items = self.targets_listbox.curselection()
@@ -120,10 +339,7 @@ class BackupManagerGUI(tk.Tk):
         try:
             with open(self.config_path, 'r') as file:
                 config = json.load(file)
-                self.backup_root = config.get('backup_root', '')
-                self.backup_root_entry.insert(0, self.backup_root)
-                self.backup_items = config.get('backup_items', [])
-                self.update_listbox_with_backup_items()
+            self.apply_settings(config)
         except FileNotFoundError:
             # 如果配置文件不存在，可以在这里初始化或忽略
             pass
@@ -133,12 +349,8 @@ class BackupManagerGUI(tk.Tk):
         file_path = filedialog.asksaveasfilename(defaultextension=".json",
                                                   filetypes=[("JSON files", "*.json")])
         if file_path:
-            config = {
-                'backup_root': self.backup_root,
-                'backup_items': self.backup_items
-            }
             with open(file_path, 'w') as file:
-                json.dump(config, file, indent=4)
+                json.dump(self.current_settings(), file, indent=4)
                 messagebox.showinfo("导出设置", "备份设置已导出。")
 
     def import_settings(self):
@@ -147,245 +359,138 @@ class BackupManagerGUI(tk.Tk):
         if file_path:
             with open(file_path, 'r') as file:
                 config = json.load(file)
-                self.backup_root = config.get('backup_root', '')
-                self.backup_items = config.get('backup_items', [])
-                self.backup_root_entry.delete(0, 'end')
-                self.backup_root_entry.insert(0, self.backup_root)
-                self.update_listbox_with_backup_items()
-                messagebox.showinfo("导入设置", "备份设置已导入。")
-                self.auto_save_settings()  # 导入后自动保存设置
+            self.apply_settings(config)
+            messagebox.showinfo("导入设置", "备份设置已导入。")
+            self.auto_save_settings()  # 导入后自动保存设置
 
     def update_listbox_with_backup_items(self):
         # 将更新listbox内容的代码提取到这个单独的函数中
         self.targets_listbox.delete(0, tk.END)
         for item in self.backup_items:
-            display_text = "{} ({})".format(item['path'], "压缩" if item['zip'] else "不压缩")
+            compression = item.get('compression', DEFAULT_COMPRESSION)
+            display_text = "{} ({}{}{}{}{}{}{})".format(item['path'], "压缩" + (
+                                                          "" if compression == DEFAULT_COMPRESSION else f"({compression})")
+                                                      if item['zip'] else "不压缩",
+                                                      ", 去重存储" if item.get('dedup') else "",
+                                                      ", 内容校验" if item.get('hash_check') else "",
+                                                      ", 快照" if item.get('snapshot') else "",
+                                                      ", 镜像" if item.get('mirror') else "",
+                                                      ", 增量拷贝" if item.get('delta') else "",
+                                                  ", 有过滤规则" if item.get('exclude') or item.get('include') else "")
             self.targets_listbox.insert('end', display_text)
                 
-    def start_backup(self):
+    def start_verify(self):
+        # 校验已有的备份与源文件是否一致，与备份共用进度、日志和取消
+        self.start_backup(verify=True)
+
+    def start_backup(self, verify=False):
         if not self.backup_root:
             messagebox.showerror("错误", "请设置一个有效的备份根目录。")
             return
 
-        # 记录开始时间：
-        start_time = time.time()
-
-        # 创建回收站
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        recycle_bin_path = os.path.join(self.backup_root, f"~备份工具回收站_{timestamp}")
-        if not os.path.exists(recycle_bin_path):
-            os.makedirs(recycle_bin_path)
-
-        # 获取并记录总备份大小
-        total_size, _ = self.calculate_total_backup_size()
-        completed_size = 0
-
+        # 剩余时间按平滑后的速度估算
+        self.throughput = ThroughputEstimator()
         self.completed_size = 0
-        self.total_size = total_size
+        self.total_size = 0
+        self.update_copy_workers()
+        self.update_recycle_retention()
 
-        # 启用取消按钮
+        # 启用取消按钮，备份期间禁止再次开始
         self.cancel_backup_button['state'] = 'normal'
-        self.backup_canceled = False
-
-        self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 开始备份进程。")
+        self.start_backup_button['state'] = 'disabled'
+        self.verify_backup_button['state'] = 'disabled'
+        self.verifying = verify
 
-        # 对于每个备份项：
-        for item in self.backup_items:
+        # 备份在后台线程中进行，界面通过事件队列获取进度、日志和错误
+        self.backup_events = queue.Queue()
+        # 完整日志写入备份根目录下的轮换日志文件，界面只显示最近的部分
+        try:
+            self.backup_log_file = RotatingLogFile(os.path.join(self.backup_root, MANIFEST_DIR_NAME, LOG_FILE_NAME))
+        except OSError as e:
+            self.backup_log_file = None
+            self.log_message(f"无法打开日志文件: {e}")
+        self.backup_engine = BackupEngine(self.backup_root, list(self.backup_items), self.copy_workers,
+                                          self.backup_events, self.compress_workers,
+                                          item_workers=max(1, self.item_workers),
+                                          device_concurrency=max(1, self.device_concurrency),
+                                          collect_metrics=self.collect_metrics.get(),
+                                          remote_destination=self.remote_destination.get(),
+                                          recycle_max_size=self.recycle_max_size_gb * 1024 ** 3,
+                                          recycle_max_age=self.recycle_max_age_days * 86400)
+        self.backup_thread = threading.Thread(target=self.backup_engine.run, args=(verify,), daemon=True)
+        self.backup_thread.start()
+        self.after(EVENT_POLL_INTERVAL_MS, self.process_backup_events)
+
+    def process_backup_events(self):
+        # 取出队列中积累的全部事件并更新界面，备份结束前持续用after()轮询
+        finished = None
+        progress = None
+        messages = []
+        records = []
+        warnings = []
+        metrics = None
+        while True:
             try:
-                self.completed_size = completed_size
-                self.update_remain_time(start_time)
-                
-                source = item['path']
-                destination = os.path.join(self.backup_root, os.path.relpath(source, start=os.path.dirname(source)))
-                is_dir = item['is_dir']
-                should_zip = item['zip']
-
-                # 检查源是否存在
-                if not os.path.exists(source):
-                    messagebox.showwarning('警告', f'源路径 {source} 不存在。')
-                    continue
-
-                # 检查是否需要更新
-                updated = self.check_updated(source, destination)
-                if not updated:
-                    self.log_message(f"未更新不备份：{source}")
-                    continue
-
-                # 如果是目录：
-                if is_dir:
-                    # 决定是否压缩
-                    if should_zip:
-                        destination += '.zip'
-                        if self.check_updated(source, destination):
-                            if os.path.exists(destination):
-                                self.move_to_recycle_bin(destination, recycle_bin_path)
-                            self.zip_directory(source, destination)
-                        else:
-                            self.log_message(f"未更新不备份：{source}")
-                            continue
-                            
-                    else:
-                        # 对于目录中的每个文件，根据需要备份
-                        for root, dirs, files in os.walk(source):
-                            for file in files:
-                                file_path = os.path.join(root, file)
-                                rel_path = os.path.relpath(file_path, start=source)
-                                dest_path = os.path.join(destination, rel_path)
-                                if self.check_updated(file_path, dest_path):
-                                    target_dir = os.path.dirname(dest_path)
-                                    if not os.path.exists(target_dir):
-                                        os.makedirs(target_dir)
-                                    if os.path.exists(dest_path):
-                                        self.move_to_recycle_bin(dest_path, recycle_bin_path)
-                                    shutil.copy2(file_path, dest_path)
-                                    self.log_message(f"备份文件：{file_path} 至 {dest_path}") # 增加此行
-
-                # 如果是单个文件，直接备份
-                else:
-                    if self.check_updated(source, destination):
-                        if os.path.exists(destination):
-                            self.move_to_recycle_bin(destination, recycle_bin_path)
-                        shutil.copy2(source, destination)
-
-                # 在拷贝每个文件后更新进度和日志
-                if not self.backup_canceled:
-                    if is_dir and should_zip:
-                        self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 压缩并备份：{source}")
-                        completed_size += self.update_progress_and_log(source, destination, total_size, completed_size)
-                        completed_size_str = self.size_to_string(completed_size, total_size)
-                        self.log_message(f"已完成 {round(100.0 * completed_size / total_size, 2)}% 的备份， {completed_size_str}")
-                    else:
-                        self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 备份：{source}")
-                        completed_size += self.update_progress_and_log(source, destination, total_size, completed_size)
-                        completed_size_str = self.size_to_string(completed_size, total_size)
-                        self.log_message(f"已完成 {round(100.0 * completed_size / total_size, 2)}% 的备份， {completed_size_str}")
-                else:
-                    self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 备份已取消。")
-                    break
-
-            except PermissionError as pe:
-                messagebox.showwarning("权限错误", f"无法访问 {source}。请检查文件的读写权限。")
-                self.log_message(f"权限错误: {pe}")
-                continue  # Skip current file and continue with the next
-
-            except OSError as ose:
-                messagebox.showwarning("操作系统错误", f"处理文件 {source} 时发生错误。")
-                self.log_message(f"操作系统错误: {ose}")
-                continue  # Skip current file and continue with the next
-              
-            except Exception as e:
-                messagebox.showwarning("未知错误", f"备份 {source} 时发生未知错误。")
-                self.log_message(f"未知错误: {e}")
-                continue  # Skip current file and continue with the next
-            
-        # 备份完成或取消，禁用取消按钮，并重置进度条
-        end_time = time.time() 
-        elapsed_time = end_time - start_time 
-        hours, remainder = divmod(int(elapsed_time), 3600)
-        minutes, seconds = divmod(remainder, 60)
-        elapsed_time_str = f"{hours}小时{minutes}分钟{seconds}秒 ({elapsed_time:.2f}秒)"
-        self.log_message(f"用时：{elapsed_time_str}")
+                event = self.backup_events.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(event, LogEvent):
+                messages.append(event.message)
+                records.append(format_log_record('info', event.message))
+            elif isinstance(event, ProgressEvent):
+                progress = event  # 只需显示最新的进度
+            elif isinstance(event, WarningEvent):
+                warnings.append(event)
+                records.append(format_log_record('warning', event.message, title=event.title))
+            elif isinstance(event, MetricsEvent):
+                metrics = event
+            elif isinstance(event, FinishedEvent):
+                finished = event
+        if messages:
+            self.log_messages(messages)
+        if records and self.backup_log_file is not None:
+            try:
+                self.backup_log_file.write_lines(records)
+            except OSError as e:
+                self.backup_log_file = None
+                self.log_message(f"写入日志文件出错，之后的日志只显示在窗口中: {e}")
+        for warning in warnings:
+            messagebox.showwarning(warning.title, warning.message)
+        if metrics is not None:
+            self.show_metrics_summary(metrics)
+        if progress is not None:
+            self.total_size = progress.total_size
+            self.completed_size = progress.completed_size
+            self.progress_bar['maximum'] = max(progress.total_size, 1)
+            self.progress_bar['value'] = progress.completed_size
+            # 多个备份目标同时进行时显示数量，总进度按字节合计
+            if len(progress.active) > 1:
+                self.progress_label['text'] = f"备份进度（{len(progress.active)} 个目标同时进行）"
+            else:
+                self.progress_label['text'] = "备份进度"
+            self.update_remain_time()
+        if finished is None:
+            self.after(EVENT_POLL_INTERVAL_MS, self.process_backup_events)
+            return
 
+        # 备份完成或取消，禁用取消按钮，并重置进度条
         self.cancel_backup_button['state'] = 'disabled'
+        self.start_backup_button['state'] = 'normal'
+        self.verify_backup_button['state'] = 'normal'
         self.progress_bar['value'] = 0
-
-        # 检查回收站是否为空，如果是，则删除
-        if os.path.exists(recycle_bin_path) and not os.listdir(recycle_bin_path):
-            shutil.rmtree(recycle_bin_path)  # 删除空的回收站目录
-            self.log_message(f"回收站 {recycle_bin_path} 是空的，已经被删除。")
-        else:
-            self.log_message(f"回收站 {recycle_bin_path} 不是空的，未被删除。")
-            
-        if not self.backup_canceled:
-            self.log_message(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())} 备份已完成。")
-            messagebox.showinfo("备份", "备份进程已完成。")
-
-        self.backup_canceled = False
+        self.progress_label['text'] = "备份进度"
+        if self.backup_log_file is not None:
+            self.backup_log_file.close()
+            self.backup_log_file = None
+        if not finished.canceled:
+            if self.verifying:
+                messagebox.showinfo("校验", "校验已完成。")
+            else:
+                messagebox.showinfo("备份", "备份进程已完成。")
 
     def cancel_backup(self):
-        self.backup_canceled = True
-
-    def size_to_string(self, size, total_size):
-        if total_size < 1024:
-            return "{}B".format(size)
-        elif total_size < 1024 ** 2:
-            return "{:.2f}KB".format(size / 1024)
-        elif total_size < 1024 ** 3:
-            return "{:.2f}MB".format(size / 1024**2)
-        else:
-            return "{:.2f}GB".format(size / 1024**3)
-        
-    def check_updated(self, source, destination):
-        # 如果目标不存在，那么认为是更新的
-        if not os.path.exists(destination):
-            return True
-        # 如果两者都是文件，则只比较修改时间
-        if os.path.isfile(source) and os.path.isfile(destination):
-            src_mtime = os.stat(source).st_mtime
-            dst_mtime = os.stat(destination).st_mtime
-            return src_mtime > dst_mtime
-        # 如果源是目录，可能需要检查压缩文件的更新时间
-        if os.path.isdir(source):
-            # 在这里，我们要考虑是否检查压缩文件
-            if destination.endswith('.zip'):
-                zip_mtime = os.stat(destination).st_mtime if os.path.exists(destination) else 0
-                for root, _, files in os.walk(source):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        if os.path.getmtime(file_path) > zip_mtime:
-                            timee = os.path.getmtime(file_path)
-                            self.log_message(f"{timee}")
-                            return True
-                return False  # 压缩文件是最新的
-            else:
-                # 非压缩的目录
-                return self.check_directory_updated(source, destination)
-        return False
-
-    def check_directory_updated(self, source_dir, destination_dir):
-        # 检查目录中是否有文件更新
-        for root, _, files in os.walk(source_dir):
-            for file in files:
-                source_file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(source_file_path, start=source_dir)
-                destination_file_path = os.path.join(destination_dir, relative_path)
-                
-                # 目标位置已存在的文件，才做比较
-                if os.path.exists(destination_file_path):
-                    src_mtime = os.stat(source_file_path).st_mtime
-                    dst_mtime = os.stat(destination_file_path).st_mtime
-                    if src_mtime > dst_mtime:
-                        return True
-                # 目标位置不存在的情况下，表明是新增的文件，也是需要更新的
-                else:
-                    return True
-        # 所有文件都是最新的，不需要更新
-        return False
-
-    def zip_directory(self, source_dir, destination_zip):
-        try:
-            # 实现目录压缩的方法
-            with zipfile.ZipFile(destination_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(source_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        arcname = os.path.relpath(file_path, start=source_dir)
-                        zipf.write(file_path, arcname)
-        except Exception as e:
-            messagebox.showwarning("错误", f"压缩目录时出错: {e}")
-            self.log_message(f"压缩目录时出错: {e}")
-
-    def move_to_recycle_bin(self, target, recycle_bin):
-        try:
-            # 实现移动文件到回收站的方法
-            target_in_bin = os.path.join(recycle_bin, os.path.relpath(target, start=self.backup_root))
-            target_dir = os.path.dirname(target_in_bin)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir)
-            shutil.move(target, target_in_bin)
-        except Exception as e:
-            messagebox.showwarning("错误", f"移动文件到回收站时出错: {e}")
-            self.log_message(f"移动文件到回收站时出错: {e}")
+        if self.backup_engine is not None:
+            self.backup_engine.cancel()
 
     def create_log_widgets(self):
         # 日志标题
@@ -412,24 +517,49 @@ class BackupManagerGUI(tk.Tk):
 
     def log_message(self, message):
         # 添加信息到日志显示窗口的方法
+        self.log_messages([message])
+
+    def log_messages(self, messages):
+        # 一批日志只插入一次，超出MAX_LOG_LINES的旧行从窗口中删除，窗口内容不会无限增长
+        messages = messages[-MAX_LOG_LINES:]
         self.log_text.config(state='normal')
-        self.log_text.insert('end', message + "\n")
+        self.log_text.insert('end', "\n".join(messages) + "\n")
+        excess = int(self.log_text.index('end-1c').split('.')[0]) - 1 - MAX_LOG_LINES
+        if excess > 0:
+            self.log_text.delete('1.0', f'{excess + 1}.0')
         self.log_text.see('end')
         self.log_text.config(state='disabled')
 
-    def update_progress_and_log(self, source, destination, total_size, completed_size):
-        # 更新进度条和日志的方法
-        item_size = os.path.getsize(source) if os.path.isfile(source) else self.get_directory_size(source)
-        self.progress_bar['maximum'] = total_size
-        self.progress_bar['value'] = completed_size + item_size
-        self.progress_bar.update()
-        return item_size
-
-    def update_remain_time(self, start_time):
-        elapsed_time = time.time() - start_time
-        remaining_time = ((self.total_size - self.completed_size) / self.completed_size * elapsed_time
-                          if self.completed_size > 0 else 0)
-        remaining_time_str = self.format_time(remaining_time)
+    def show_metrics_summary(self, event):
+        # 性能统计汇总面板：每个备份目标各阶段的用时、文件数和大小，以及用时最长的文件
+        window = tk.Toplevel(self)
+        window.title("性能统计")
+        columns = ('phase', 'seconds', 'files', 'size')
+        tree = ttk.Treeview(window, columns=columns, height=15)
+        tree.heading('#0', text="备份目标 / 阶段")
+        for column, text in zip(columns, ("阶段", "用时(秒)", "文件数", "大小(MB)")):
+            tree.heading(column, text=text)
+            tree.column(column, width=90, anchor='e')
+        tree.column('#0', width=300)
+        for target, phases in event.summary['targets'].items():
+            parent = tree.insert('', 'end', text=target, open=True)
+            for phase, value in sorted(phases.items(), key=lambda pair: -pair[1]['seconds']):
+                tree.insert(parent, 'end', text='', values=(PHASE_NAMES.get(phase, phase), f"{value['seconds']:.3f}",
+                                                            value['files'], f"{value['bytes'] / 1024 ** 2:.2f}"))
+        for strategy, value in event.summary.get('copy_methods', {}).items():
+            parent = tree.insert('', 'end', text=f"拷贝方式 {strategy}", values=(
+                '', f"{value['seconds']:.3f}", value['files'], f"{value['bytes'] / 1024 ** 2:.2f}"))
+        tree.pack(fill='both', expand=True)
+        slowest = "\n".join(f"{item['seconds']:.3f}秒 {PHASE_NAMES.get(item['phase'], item['phase'])} {item['path']}"
+                            for item in event.summary['slowest'])
+        tk.Label(window, text=f"用时最长的文件：\n{slowest}" if slowest else "", justify='left').pack(anchor='w')
+        if event.path:
+            tk.Label(window, text=f"统计文件：{event.path}").pack(anchor='w')
+
+    def update_remain_time(self):
+        self.throughput.update(self.completed_size)
+        remaining_time = self.throughput.remaining_seconds(self.completed_size, self.total_size)
+        remaining_time_str = self.format_time(remaining_time) if remaining_time is not None else "估算中"
         self.remaining_time_label['text'] = f"剩余时间: {remaining_time_str}"
 
     def format_time(self, seconds):
@@ -438,24 +568,6 @@ class BackupManagerGUI(tk.Tk):
         minutes, seconds = divmod(remainder, 60)
         return f"{hours:02}:{minutes:02}:{seconds:02}"
 
-    def calculate_total_backup_size(self):
-        # 计算备份总大小的方法
-        total_size = 0
-        for item in self.backup_items:
-            source = item['path']
-            item_size = os.path.getsize(source) if os.path.isfile(source) else self.get_directory_size(source)
-            total_size += item_size
-        return total_size, len(self.backup_items)
-
-    def get_directory_size(self, path):
-        # 递归获取目录大小的方法
-        total = 0
-        for dirpath, _, filenames in os.walk(path):
-            for f in filenames:
-                fp = os.path.join(dirpath, f)
-                total += os.path.getsize(fp)
-        return total
-        
     def run(self):
         self.mainloop()
 